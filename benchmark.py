@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import statistics
+from typing import Callable, Dict, List
+
+import level_pack
+from rules import Level, State
+
+# Benchmarks for the rules engine and the game's hot paths:
+# - the rules on synthetic boards far larger than any real level
+# - every level in levels/, loaded through LevelUI.load_level_spec on a headless
+#   display, for load time, render rate and moves per second
+# - synthetic boards of increasing size played through the same UI code
+#
+# Run from the repository root as `python benchmark.py`. Results can be written as
+# JSON with --output and checked against a stored baseline with --baseline, which
+# lists every metric that got worse by more than --tolerance and exits non-zero.
+# Every run also times a fixed workload that doesn't touch the game's code, and the
+# baseline is scaled by how much faster or slower that ran, so a baseline recorded on
+# one machine can be checked on another. Rates are the median of several samples, taken
+# after a warm-up pass that fills the font, glyph and sprite caches, and a benchmark that
+# looks worse than the baseline is run again before it counts as a regression.
+
+FACE_MIX = ["1", "2", "3", "5", "+1", "-2", "x3", "/2", "=3", "=5"]
+UI_SIZES = [10, 50, 100, 200]
+BASELINE = "benchmark_baseline.json"
+CALIBRATION = "calibration"             # results entry for the machine speed reference
+SAMPLES = 5                             # samples per rate, of which the median is kept
+RETRIES = 2                             # extra runs of a benchmark that looks worse than the baseline
+
+# Metrics noisier than the --tolerance allows. A hover render takes well under a
+# millisecond, so a single scheduler hiccup shows up as a large change.
+TOLERANCES = {"hover_fps": 0.5}
+
+Results = Dict[str, Dict[str, float]]   # benchmark name -> metric -> value
+
+
+# Every triangle holds a die and they all chain off a single number, so one evaluation
+# walks all width*height*2 dice in a single depth-first pass
+def chain_level(width: int, height: int) -> Level:
+    objects = []
+    for x in range(width):
+        for y in range(height):
+            for r in range(2):
+                face = "1" if (x, y, r) == (0, 0, 0) else "x1"
+                objects.append({"type": "d4", "loc": [x, y, r], "faces": [face] * 4})
+    return Level.from_spec({"dim": [width, height], "objects": objects})
+
+
+# Dice on a random share of the triangles with a random mix of faces
+def random_level(width: int, height: int, density: float=0.5, seed: int=0) -> Level:
+    rng = random.Random(seed)
+    objects = []
+    for x in range(width):
+        for y in range(height):
+            for r in range(2):
+                if rng.random() < density:
+                    objects.append({"type": "d4", "loc": [x, y, r], "faces": [rng.choice(FACE_MIX) for _ in range(4)]})
+    return Level.from_spec({"dim": [width, height], "objects": objects})
+
+
+# A playable level spec for the UI: dice and walls on a random share of the triangles,
+# and the player on one of the rest
+def synthetic_spec(size: int, density: float=0.3, walls: float=0.05, seed: int=0) -> dict:
+    rng = random.Random(seed)
+    objects = []
+    free = []
+    for x in range(size):
+        for y in range(size):
+            for r in range(2):
+                roll = rng.random()
+                if roll < density:
+                    objects.append({"type": "d4", "loc": [x, y, r], "faces": [rng.choice(FACE_MIX) for _ in range(4)]})
+                elif roll < density + walls:
+                    objects.append({"type": "wall", "loc": [x, y, r]})
+                else:
+                    free.append([x, y, r])
+    objects.append({"type": "start", "loc": rng.choice(free)})
+    return {"name": f"Synthetic {size}x{size}", "dim": [size, size], "level": 1, "objects": objects}
+
+
+# Best wall time of a few runs, in seconds
+def best_of(f: Callable[[], object], runs: int=3) -> float:
+    times: List[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# Calls per second of f(i) for i = 0, 1, ..., as the median of several samples that each
+# take at least min_time seconds and min_calls calls
+def rate(f: Callable[[int], object], samples: int=SAMPLES, min_time: float=0.2, min_calls: int=5, max_calls: int=20000) -> float:
+    rates: List[float] = []
+    calls = 0
+    for _ in range(samples):
+        count = 0
+        start = time.perf_counter()
+        while count < max_calls:
+            f(calls)
+            calls += 1
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time and count >= min_calls:
+                break
+        rates.append(count / elapsed)
+    return statistics.median(rates)
+
+
+# Time a fixed pure-Python workload, in milliseconds, to tell how fast the machine is
+def calibrate() -> Dict[str, float]:
+    def work() -> list:
+        table = dict()
+        for i in range(200000):
+            table[(i*7919) % 1009, i & 7] = str(i)
+        return sorted(table.items())
+    reference = best_of(work, 5)
+    print(f"calibration: reference workload {reference*1000:.1f}ms")
+    return {"reference_ms": reference*1000}
+
+
+def run(name: str, build: Callable[[], Level]) -> Dict[str, float]:
+    start = time.perf_counter()
+    level = build()
+    load = time.perf_counter() - start
+
+    state = level.start
+    evaluation = level.evaluate(state)
+    valued = sum(v is not None for v in evaluation.values)
+
+    # Turn one die in the middle over, as a move would
+    (loc, o) = state.dice[len(state.dice) // 2]
+    dice = list(state.dice)
+    dice[len(dice) // 2] = (loc, (o + 1) % 12)
+    turned = State(state.player, tuple(dice))
+
+    full = best_of(lambda: level.evaluate(state), 5)
+    incremental = best_of(lambda: level.reevaluate(turned, state, evaluation), 5)
+    print(f"{name}: {len(state.dice)} dice, {valued} with values, load {load:.2f}s, "
+          f"evaluate {full*1000:.1f}ms, reevaluate {incremental*1000:.1f}ms")
+    return {"load_ms": load*1000, "evaluate_ms": full*1000, "reevaluate_ms": incremental*1000}
+
+
+# Open a display to render into, headless unless a video driver was picked
+def open_screen():
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    pygame.init()
+    return pygame.display.set_mode([1600, 900])
+
+
+# Play a level through the UI without timing anything, so the first level measured
+# doesn't pay for building the font, glyph and sprite caches
+def warm_up(spec: dict, screen) -> None:
+    from level_ui import LevelUI
+    level_ui = LevelUI(screen)
+    level_ui.load_level_spec(spec)
+    grid = level_ui.grid
+    for _ in range(3):
+        level_ui.render_all((0, 0), True)
+    for m in grid.legal_moves():
+        level_ui.handle_click(grid.triangle_centre(*m.target()))
+        level_ui.render_all((0, 0))
+        grid.undo()
+    grid.close()
+
+
+# Load a level through the UI and time loading, full and hover renders, and moves
+def run_ui(name: str, spec: dict, screen) -> Dict[str, float]:
+    from level_ui import LevelUI
+    level_ui = LevelUI(screen)
+    load = best_of(lambda: level_ui.load_level_spec(spec))
+    grid = level_ui.grid
+
+    # The first frame builds every die's sprite, so it isn't counted
+    level_ui.render_all((0, 0), True)
+    full_fps = rate(lambda i: level_ui.render_all((0, 0), True), max_calls=20)
+
+    # Sweep the mouse over the triangles around the player, so arrows appear and go
+    hover = [grid.triangle_centre(*loc) for (_, loc) in grid.level.neighbours(*grid.state.player)] + [(0, 0)]
+    hover_fps = rate(lambda i: level_ui.render_all(hover[i % len(hover)]))
+
+    # Make each legal move by clicking it, then undo it
+    targets = [grid.triangle_centre(*m.target()) for m in grid.legal_moves()]
+    def move_and_undo(i):
+        level_ui.handle_click(targets[i % len(targets)])
+        grid.undo()
+    moves = rate(move_and_undo) if targets else 0.0
+    grid.close()
+
+    print(f"{name}: {len(grid.dice)} dice, load {load*1000:.1f}ms, full render {full_fps:.1f} fps, "
+          f"hover render {hover_fps:.1f} fps, {moves:.0f} moves/s")
+    return {"load_ms": load*1000, "render_fps": full_fps, "hover_fps": hover_fps, "moves_per_sec": moves}
+
+
+# List the metrics that are worse than the baseline by more than the tolerance, or by
+# more than their own in TOLERANCES, by benchmark. Times (ending in _ms) should go down
+# and rates up. The baseline is first scaled by how long the calibration workload took
+# in each.
+def regressions(results: Results, baseline: Results, tolerance: float) -> Dict[str, List[str]]:
+    scale = 1.0
+    if CALIBRATION in results and CALIBRATION in baseline:
+        scale = results[CALIBRATION]["reference_ms"] / baseline[CALIBRATION]["reference_ms"]
+
+    worse: Dict[str, List[str]] = dict()
+    for (name, metrics) in results.items():
+        if name == CALIBRATION:
+            continue
+        for (metric, value) in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if not base:
+                continue
+            expected = base*scale if metric.endswith("_ms") else base/scale
+            change = value/expected - 1 if metric.endswith("_ms") else expected/value - 1 if value else math.inf
+            if change > max(tolerance, TOLERANCES.get(metric, 0.0)):
+                worse.setdefault(name, []).append(f"{name} {metric}: {value:.1f} against {expected:.1f} ({change:+.0%} worse)")
+    return worse
+
+
+# Keep the better of two results for every metric
+def best_metrics(a: Dict[str, float], b: Dict[str, float]) -> Dict[str, float]:
+    return {m: min(a[m], b[m]) if m.endswith("_ms") else max(a[m], b[m]) for m in a}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the rules and the game's hot paths.")
+    parser.add_argument("size", nargs="?", type=int, default=100, help="size of the boards for the rules benchmarks")
+    parser.add_argument("--ui-sizes", type=int, nargs="*", default=UI_SIZES, help="sizes of the synthetic boards played through the UI")
+    parser.add_argument("--rules-only", action="store_true", help="skip the UI benchmarks")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", nargs="?", const=BASELINE, help=f"compare against a results file (default {BASELINE})")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much worse than the baseline a metric may be")
+    args = parser.parse_args()
+
+    # Every benchmark by the name its results are stored under
+    size = args.size
+    benchmarks: Dict[str, Callable[[], Dict[str, float]]] = dict()
+    benchmarks[f"rules chain {size}x{size}"] = lambda: run(f"chain {size}x{size}", lambda: chain_level(size, size))
+    benchmarks[f"rules random {size}x{size}"] = lambda: run(f"random {size}x{size}", lambda: random_level(size, size))
+    if not args.rules_only:
+        screen = open_screen()
+        pack = level_pack.open_dir(os.path.join(os.getcwd(), 'levels'))
+        specs = [pack.spec(name) for name in pack.entries]
+        pack.close()
+        warm_up(specs[0], screen)
+        for spec in specs:
+            benchmarks[f"level {spec['level']}"] = lambda spec=spec: run_ui(f"level {spec['level']} ({spec['name']})", spec, screen)
+        for ui_size in args.ui_sizes:
+            benchmarks[f"ui {ui_size}x{ui_size}"] = lambda ui_size=ui_size: run_ui(f"synthetic {ui_size}x{ui_size}", synthetic_spec(ui_size), screen)
+
+    results: Results = dict()
+    results[CALIBRATION] = calibrate()
+    for (name, benchmark) in benchmarks.items():
+        results[name] = benchmark()
+
+    # Calibrate again at the end and keep the faster, in case the machine was busy at the start
+    results[CALIBRATION] = min(results[CALIBRATION], calibrate(), key=lambda c: c["reference_ms"])
+
+    worse: Dict[str, List[str]] = dict()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        worse = regressions(results, baseline, args.tolerance)
+
+        # The machine may just have been busy for a moment, so benchmarks that look worse
+        # are run again, keeping the best of every metric
+        for _ in range(RETRIES):
+            if not worse:
+                break
+            print(f"Running {', '.join(worse)} again")
+            for name in worse:
+                results[name] = best_metrics(results[name], benchmarks[name]())
+            worse = regressions(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({name: {m: round(v, 3) for (m, v) in metrics.items()} for (name, metrics) in results.items()}, f, indent=4)
+    for lines in worse.values():
+        for line in lines:
+            print("Regression:", line)
+    sys.exit(1 if worse else 0)
@@ -0,0 +1,186 @@
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from rules import Coord, Level, NUM, ORIENTATIONS, State, roll
+
+# Dead-state detection. Every die is analysed on its own over a relaxed version of the
+# rules in which the player can always get behind it and no other die is ever in the
+# way, built from nothing but the walls and fronts. Anything a die can't do even then
+# it can't do in the real game. On top of that, dice wedged in by walls and each other
+# can never move again, so their equations are already final. A state flagged dead can
+# never be won, and a search can drop it without losing a solution.
+
+class Deadlocks:
+    MAX_VERDICTS: int = 65536           # dice placements kept in the verdict cache
+
+    level: Level
+    cornered: bytearray                 # 1 for the cell id of every triangle a die can never be pushed out of
+    live: List[bytearray]               # per die, 1 at cell*12 + orientation if it can still end up somewhere useful
+    open_sides: List[List[Tuple[int, int]]]     # per cell, (direction, cell) of every neighbour that isn't a wall
+    verdicts: Dict[tuple, bool]         # stuck dice verdicts by dice placement, least recently used first, for placements with a die in a dead cell
+
+    def __init__(self, level: Level):
+        self.level = level
+        n = len(level.cells)
+        k = len(ORIENTATIONS)
+
+        # A die moves out of a triangle between two open sides: pushed in through one,
+        # it rolls (or slides, on a front) out through the other
+        self.open_sides = open_sides = [
+            [(d, level.ids[adj]) for (d, adj) in level.neighbours(*loc) if adj not in level.walls]
+            for loc in level.cells
+        ]
+        self.cornered = bytearray(len(open_sides[c]) < 2 for c in range(n))
+        self.verdicts = OrderedDict()
+
+        # In a won state every die is valid: a number is valid by itself, but any other
+        # face needs a die next to it, so it must end next to an open triangle and there
+        # must be another die. Dice showing numbers in the same orientations share their
+        # analysis, so there are at most 16 of them however many dice there are.
+        playable = [c for c in range(n) if level.cells[c] not in level.walls]
+        tables: Dict[tuple, bytearray] = dict()
+        self.live = []
+        if len(level.die_faces) > 1:
+            # With another die, every orientation next to an open triangle is a goal, and
+            # a die with no open side can't be pushed anywhere, so the goals are all
+            # there is: no search is needed
+            base = bytearray(n*k)
+            closed = []
+            for c in playable:
+                if open_sides[c]:
+                    base[c*k:(c + 1)*k] = b"\x01"*k
+                else:
+                    closed.append(c)
+            for i in range(len(level.die_faces)):
+                numbers = tuple(level.top_op(i, o)[0] == NUM for o in range(k))
+                if numbers not in tables:
+                    live = tables[numbers] = bytearray(base)
+                    for c in closed:
+                        for o in range(k):
+                            live[c*k + o] = numbers[o]
+                self.live.append(tables[numbers])
+        elif level.die_faces:
+            # A lone die has to show a number, and can get there by being pushed around
+            numbers = tuple(level.top_op(0, o)[0] == NUM for o in range(k))
+            goals = [c*k + o for c in playable for o in range(k) if numbers[o]]
+            self.live.append(self._reaching(goals, self._predecessors()))
+
+    # Predecessors in the relaxed move graph over (cell, orientation) nodes
+    def _predecessors(self) -> List[List[int]]:
+        level = self.level
+        k = len(ORIENTATIONS)
+        before: List[List[int]] = [[] for _ in range(len(level.cells)*k)]
+        for (c, loc) in enumerate(level.cells):
+            if loc in level.walls:
+                continue
+            front = loc in level.fronts
+            sides = self.open_sides[c]
+            for (player_d, _) in sides:
+                for (d, q) in sides:
+                    if d == player_d:
+                        continue
+                    for o in range(k):
+                        before[q*k + roll(o, d, front, player_d)].append(c*k + o)
+        return before
+
+    # Mark every node from which one of the goals can be reached
+    @staticmethod
+    def _reaching(goals: List[int], before: List[List[int]]) -> bytearray:
+        live = bytearray(len(before))
+        queue = deque(goals)
+        for g in goals:
+            live[g] = 1
+        while queue:
+            node = queue.popleft()
+            for prev in before[node]:
+                if not live[prev]:
+                    live[prev] = 1
+                    queue.append(prev)
+        return live
+
+    # Find the dice that can never move again: a die needs two sides free of walls and
+    # stuck dice to be pushed through, and every die that gets stuck can wedge in more
+    def stuck_dice(self, state: State) -> Set[int]:
+        ids = self.level.ids
+        cells = [ids[loc] for (loc, _) in state.dice]
+        stuck = {i for (i, c) in enumerate(cells) if len(self.open_sides[c]) < 2}
+        if not stuck:
+            return stuck
+
+        # Only dice next to a newly stuck die can get stuck in turn
+        at = {c: i for (i, c) in enumerate(cells)}
+        stuck_cells = {cells[i] for i in stuck}
+        todo = list(stuck_cells)
+        while todo:
+            for (_, q) in self.open_sides[todo.pop()]:
+                i = at.get(q)
+                if i is None or i in stuck:
+                    continue
+                if sum(p not in stuck_cells for (_, p) in self.open_sides[q]) < 2:
+                    stuck.add(i)
+                    stuck_cells.add(q)
+                    todo.append(q)
+        return stuck
+
+    # Check whether die i, in the given cell and orientation, could make a state dead:
+    # it can't end up anywhere useful, or it is in a dead cell. A state with no such die
+    # isn't dead.
+    def suspect(self, i: int, loc: Coord, orientation: int) -> bool:
+        c = self.level.ids[loc]
+        return not self.live[i][c*len(ORIENTATIONS) + orientation] or bool(self.cornered[c])
+
+    # Check whether a state can no longer be won. If suspects is given, it must hold every
+    # die for which suspect is true; the other dice aren't looked at one by one.
+    def is_dead(self, state: State, suspects: Optional[Iterable[int]]=None) -> bool:
+        ids = self.level.ids
+        k = len(ORIENTATIONS)
+        cornered = False
+        for i in range(len(state.dice)) if suspects is None else suspects:
+            (loc, o) = state.dice[i]
+            c = ids[loc]
+            if not self.live[i][c*k + o]:
+                return True
+            cornered = cornered or self.cornered[c]
+        if not cornered:
+            return False
+
+        # Working out stuck dice is slower, but only depends on where the dice are
+        verdict = self.verdicts.get(state.dice)
+        if verdict is not None:
+            self.verdicts.move_to_end(state.dice)
+            return verdict
+        verdict = self.verdicts[state.dice] = self._stuck_dead(state)
+        if len(self.verdicts) > self.MAX_VERDICTS:
+            self.verdicts.popitem(last=False)
+        return verdict
+
+    def _stuck_dead(self, state: State) -> bool:
+        ids = self.level.ids
+
+        # A group of stuck dice next to nothing but walls and each other can't get any
+        # other value, so every one of them must already be valid
+        stuck = self.stuck_dice(state)
+        if not stuck:
+            return False
+        at = {ids[state.dice[i][0]]: i for i in stuck}
+        seen: Set[int] = set()
+        valid = None
+        for c in at:
+            if c in seen:
+                continue
+            group = [c]
+            seen.add(c)
+            sealed = True
+            for g in group:
+                for (_, q) in self.open_sides[g]:
+                    if q not in at:
+                        sealed = False
+                    elif q not in seen:
+                        seen.add(q)
+                        group.append(q)
+            if sealed:
+                if valid is None:
+                    valid = self.level.evaluate(state).valid
+                if any(valid[at[g]] != True for g in group):
+                    return True
+        return False
@@ -0,0 +1,213 @@
+import numpy
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from equations import INVALID, UNSET, VALID, op_tables
+from rules import Direction, Level, Move, ORIENTATIONS, ROLL, State, TURNS
+
+# N copies of a level stepped together on stacked numpy arrays, for automated
+# playtesting and agent training. Movement, pushes and die rolls/slides are fully
+# vectorised. Equations only need evaluating when a die moves, and their results are
+# cached by dice placement, so boards keep hitting the cache once play settles down.
+# The cache keeps the placements used most recently, so it stays the same size however
+# long training runs.
+#
+# An action is 3*d + kind for player direction d, where kind is WALK to step into an
+# empty triangle, or PUSH_LEFT/PUSH_RIGHT to push the die there out through its
+# left or right side. An illegal action leaves the board as it is.
+
+WALK = 0
+PUSH_LEFT = 1
+PUSH_RIGHT = 2
+ACTIONS = 9
+
+EMPTY = -1                              # occupant of an empty triangle
+
+
+# Get the action for a rules move
+def action_for(move: Move) -> int:
+    if move.dice_end is None:
+        return 3*move.player_dir + WALK
+    if move.dice_dir == Direction.left(move.player_dir):
+        return 3*move.player_dir + PUSH_LEFT
+    return 3*move.player_dir + PUSH_RIGHT
+
+
+class BatchEnv:
+    WIN_REWARD: float = 1.0
+    STEP_REWARD: float = -0.01
+    ILLEGAL_REWARD: float = -0.1
+    MAX_EVALUATIONS: int = 65536        # dice placements kept in the evaluation cache
+
+    level: Level
+    n: int                              # number of boards
+    max_steps: int                      # boards are done after this many steps
+    adjacent: numpy.ndarray             # int32 (cells, 3): neighbouring cell in each direction, or -1
+    walls: numpy.ndarray                # bool per cell
+    fronts: numpy.ndarray               # bool per cell
+    turns: numpy.ndarray                # int8 (12, 3, 4): rules.TURNS
+    opcodes: numpy.ndarray              # int8 (dice, 12): compiled top face of every die in every orientation
+    operands: numpy.ndarray             # int64 (dice, 12)
+
+    player: numpy.ndarray               # int32 (n,): player cell
+    die_cells: numpy.ndarray            # int32 (n, dice)
+    orientations: numpy.ndarray         # int8 (n, dice)
+    occupant: numpy.ndarray             # int16 (n, cells): index of the die on the cell, the dice count for the player, or EMPTY
+    valid: numpy.ndarray                # int8 (n, dice): equations.VALID, INVALID or UNSET
+    won: numpy.ndarray                  # bool (n,)
+    steps: numpy.ndarray                # int32 (n,): steps since the board was reset
+    evaluations: Dict[bytes, Tuple[numpy.ndarray, bool]]    # dice placement -> (validity, won), least recently used first
+
+    def __init__(self, level: Level, n: int, max_steps: int=200):
+        if level.start.player is None:
+            raise ValueError("Level has no start for the player")
+        self.level = level
+        self.n = n
+        self.max_steps = max_steps
+        cells = len(level.cells)
+        k = len(level.start.dice)
+
+        self.adjacent = numpy.array(level.adjacent, dtype=numpy.int32).reshape(cells, 3)
+        self.walls = numpy.zeros(cells, dtype=bool)
+        self.walls[[level.ids[loc] for loc in level.walls]] = True
+        self.fronts = numpy.zeros(cells, dtype=bool)
+        self.fronts[[level.ids[loc] for loc in level.fronts]] = True
+        self.turns = numpy.array(TURNS, dtype=numpy.int8)
+        (self.opcodes, self.operands) = op_tables(level)
+        self.evaluations = OrderedDict()
+
+        self.player = numpy.zeros(n, dtype=numpy.int32)
+        self.die_cells = numpy.zeros((n, k), dtype=numpy.int32)
+        self.orientations = numpy.zeros((n, k), dtype=numpy.int8)
+        self.occupant = numpy.full((n, cells), EMPTY, dtype=numpy.int16)
+        self.valid = numpy.zeros((n, k), dtype=numpy.int8)
+        self.won = numpy.zeros(n, dtype=bool)
+        self.steps = numpy.zeros(n, dtype=numpy.int32)
+
+        # Template rows copied into boards on reset
+        self._start_player = level.ids[level.start.player]
+        self._start_cells = numpy.array([level.ids[loc] for (loc, _) in level.start.dice], dtype=numpy.int32)
+        self._start_orientations = numpy.array([o for (_, o) in level.start.dice], dtype=numpy.int8)
+        self._start_occupant = numpy.full(cells, EMPTY, dtype=numpy.int16)
+        self._start_occupant[self._start_cells] = numpy.arange(k)
+        self._start_occupant[self._start_player] = k
+        self.reset()
+
+    # Put the given boards (all of them by default) back to the start of the level
+    def reset(self, mask: Optional[numpy.ndarray]=None) -> Dict[str, numpy.ndarray]:
+        rows = slice(None) if mask is None else mask
+        self.player[rows] = self._start_player
+        self.die_cells[rows] = self._start_cells
+        self.orientations[rows] = self._start_orientations
+        self.occupant[rows] = self._start_occupant
+        self.steps[rows] = 0
+        (valid, won) = self._evaluate(self._start_cells, self._start_orientations)
+        self.valid[rows] = valid
+        self.won[rows] = won
+        return self.observe()
+
+    # Validity and win for one dice placement, from the cache or the rules
+    def _evaluate(self, cells: numpy.ndarray, orientations: numpy.ndarray) -> Tuple[numpy.ndarray, bool]:
+        key = (cells.astype(numpy.int64)*len(ORIENTATIONS) + orientations).tobytes()
+        result = self.evaluations.get(key)
+        if result is not None:
+            self.evaluations.move_to_end(key)
+            return result
+
+        level = self.level
+        dice = tuple((level.cells[c], int(o)) for (c, o) in zip(cells.tolist(), orientations.tolist()))
+        evaluation = level.evaluate(State(None, dice))
+        valid = numpy.array([UNSET if v is None else VALID if v else INVALID for v in evaluation.valid], dtype=numpy.int8)
+        result = self.evaluations[key] = (valid, evaluation.won)
+        if len(self.evaluations) > self.MAX_EVALUATIONS:
+            self.evaluations.popitem(last=False)
+        return result
+
+    # Work out what every action would do on every board
+    def _resolve(self, actions: numpy.ndarray) -> Tuple[numpy.ndarray, ...]:
+        boards = numpy.arange(self.n)
+        k = self.die_cells.shape[1]
+        d = actions // 3
+        kind = actions % 3
+
+        # The triangle the player steps into, and what is on it
+        adj = self.adjacent[self.player, d]
+        on_grid = adj >= 0
+        adj = numpy.where(on_grid, adj, 0)
+        occupant = numpy.where(on_grid & ~self.walls[adj], self.occupant[boards, adj], k)
+
+        walk = (kind == WALK) & (occupant == EMPTY)
+
+        # A die there goes out through the side the action picks, into an empty triangle
+        die_d = numpy.where(kind == PUSH_LEFT, (d + 2) % 3, (d + 1) % 3)
+        dest = self.adjacent[adj, die_d]
+        dest_ok = dest >= 0
+        dest = numpy.where(dest_ok, dest, 0)
+        push = (kind != WALK) & (occupant >= 0) & (occupant < k) & dest_ok & ~self.walls[dest] & (self.occupant[boards, dest] == EMPTY)
+        return (d, adj, occupant, walk, push, die_d, dest)
+
+    # Get which actions are legal on every board, as a bool array (n, ACTIONS)
+    def legal_mask(self) -> numpy.ndarray:
+        mask = numpy.zeros((self.n, ACTIONS), dtype=bool)
+        for a in range(ACTIONS):
+            (_, _, _, walk, push, _, _) = self._resolve(numpy.full(self.n, a))
+            mask[:, a] = walk | push
+        return mask
+
+    # Apply one action per board. Returns (observations, rewards, done). Boards that are
+    # done stay as they are until reset.
+    def step(self, actions: numpy.ndarray) -> Tuple[Dict[str, numpy.ndarray], numpy.ndarray, numpy.ndarray]:
+        actions = numpy.asarray(actions, dtype=numpy.int64)
+        (d, adj, occupant, walk, push, die_d, dest) = self._resolve(actions)
+        k = self.die_cells.shape[1]
+        was_won = self.won.copy()
+        active = ~(self.won | (self.steps >= self.max_steps))
+        walk &= active
+        push &= active
+        moved = walk | push
+
+        # Roll or slide the pushed dice, the way rules.Level.step does
+        pb = numpy.nonzero(push)[0]
+        if len(pb):
+            i = occupant[pb]
+            o = self.orientations[pb, i]
+            slide = numpy.where(self.fronts[adj[pb]], d[pb], ROLL)
+            self.orientations[pb, i] = self.turns[o, die_d[pb], slide]
+            self.die_cells[pb, i] = dest[pb]
+            self.occupant[pb, dest[pb]] = i
+
+        mb = numpy.nonzero(moved)[0]
+        self.occupant[mb, self.player[mb]] = EMPTY
+        self.occupant[mb, adj[mb]] = k
+        self.player[mb] = adj[mb]
+        self.steps[active] += 1
+
+        # Only boards where a die moved need their equations looked at again
+        for b in pb.tolist():
+            (self.valid[b], self.won[b]) = self._evaluate(self.die_cells[b], self.orientations[b])
+
+        rewards = numpy.where(moved, self.STEP_REWARD, self.ILLEGAL_REWARD)
+        rewards = numpy.where(active, rewards, 0.0)
+        rewards += numpy.where(self.won & ~was_won, self.WIN_REWARD, 0.0)
+        done = self.won | (self.steps >= self.max_steps)
+        return (self.observe(), rewards, done)
+
+    # Get every board as arrays: player cell, dice cells and orientations, the compiled
+    # top face of every die, whether each die is valid, and whether the board is won
+    def observe(self) -> Dict[str, numpy.ndarray]:
+        dice = numpy.arange(self.die_cells.shape[1])
+        return {
+            "player": self.player.copy(),
+            "dice": self.die_cells.copy(),
+            "orientations": self.orientations.copy(),
+            "opcodes": self.opcodes[dice, self.orientations],
+            "operands": self.operands[dice, self.orientations],
+            "valid": self.valid.copy(),
+            "won": self.won.copy(),
+        }
+
+    # Get the rules state of one board
+    def state(self, b: int) -> State:
+        cells = self.level.cells
+        dice = tuple((cells[c], o) for (c, o) in zip(self.die_cells[b].tolist(), self.orientations[b].tolist()))
+        return State(cells[self.player[b]], dice)
@@ -0,0 +1,24 @@
+import numpy
+from typing import Tuple
+
+from rules import ORIENTATIONS, Level
+
+# Compiled faces (see rules.compile_face) as numpy tables, for batch analysis of many
+# board states at once. Validity is stored as int8: 1 for valid, 0 for invalid and -1
+# for a die that never got a value (None in rules.Evaluation).
+
+VALID = 1
+INVALID = 0
+UNSET = -1
+
+
+# Get the compiled top face of every die in every orientation as (opcodes, operands),
+# each of shape (dice, orientations)
+def op_tables(level: Level) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    k = len(level.die_faces)
+    opcodes = numpy.zeros((k, len(ORIENTATIONS)), dtype=numpy.int8)
+    operands = numpy.zeros((k, len(ORIENTATIONS)), dtype=numpy.int64)
+    for i in range(k):
+        for o in range(len(ORIENTATIONS)):
+            (opcodes[i, o], operands[i, o]) = level.top_op(i, o)
+    return (opcodes, operands)
@@ -1,35 +1,51 @@
 import math
 import os
-import json
-from typing import List
+import time
+from typing import Dict, List
 from functools import partial
 from pygame_button import Button
 
+import images
+import level_pack
+from level_pack import LevelPack, PackEntry
 from level_ui import LevelUI
+from profiler import PROFILER
 from styles import BUTTON_STYLE, WHITE, GREY, RED
 
-# Import and initialize the pygame library
+# Import the pygame library; Game initializes it
 import pygame
-pygame.init()
 
 class Game:
+    FPS: int = 60                       # default frame rate cap
+    HINT_POLL_MS: int = 50              # how often to check for a hint while one is being searched for
+    PROFILER_MS: int = 250              # how often to refresh the profiler overlay when nothing else happens
+    REPLAY_DIR: str = "replays"         # where the inputs of every won level are saved
+
     screen: pygame.Surface
-    levels: dict
+    pack: LevelPack                     # compiled levels, decoded one at a time as they are played
+    levels: Dict[str, PackEntry]        # index of the pack by level name
     buttons: List[Button]
 
     running: bool
     paused: bool
     state: str
+    redraw_all: bool                    # whether the whole screen has to be redrawn and pushed next frame
 
     level_ui: LevelUI
+    clock: pygame.time.Clock
+    fps: int                            # frame rate cap
 
-    def __init__(self):
+    def __init__(self, fps: int=FPS):
         pygame.init()
+        self.clock = pygame.time.Clock()
+        self.fps = fps
+        self.redraw_all = True
 
         # Set up the drawing window
         self.screen = pygame.display.set_mode([1600, 900])
         #self.screen.set_caption('Thunder Bolt')
         self.level_ui = LevelUI(self.screen)
+        images.preload_level(0)
 
         # Load all the levels
         self.load_levels()
@@ -40,28 +56,23 @@ class Game:
         # Render the menu
         self.render_menu()
 
-    # Load all levels from the 'levels' directory
+    # Open the levels in the 'levels' directory. Only the pack's index is read here.
     def load_levels(self) -> None:
-        self.levels = dict()
-        level_dir = os.path.join(os.getcwd(), 'levels')
-        for filename in os.listdir(level_dir):
-            if filename.endswith('.json'):
-                f = open(os.path.join(level_dir, filename))
-                l = json.load(f)
-                self.levels[l["name"]] = l
-                f.close()
+        self.pack = level_pack.open_dir(os.path.join(os.getcwd(), 'levels'))
+        self.levels = self.pack.entries
 
     # Clear the screen and buttons
     def clear_screen(self) -> None:
         self.screen.fill(WHITE)
         self.buttons = []
+        self.redraw_all = True
 
     # Render a given level
     def render_level(self, level_name: str) -> None:
         self.clear_screen()
         self.state = level_name
         self.paused = False
-        level_spec = self.levels[level_name]
+        level_spec = self.pack.spec(level_name)
         self.level_ui.load_level_spec(level_spec)
     # Render the menu
     def render_menu(self) -> None:
@@ -71,7 +82,7 @@ class Game:
         # Make a button for each level
         for level_name in self.levels:
             self.buttons.append(Button(
-                (500, 200 + 50*self.levels[level_name]["level"], 600, 50),
+                (500, 200 + 50*self.levels[level_name].number, 600, 50),
                 GREY,
                 partial(self.render_level, level_name),
                 text=level_name,
@@ -94,7 +105,10 @@ class Game:
         text_surface = title_font.render("Instructions", False, (0, 0, 0))
         instruction_set = ["Make a valid math problem with all of the dice.", 
         "Press 'U' to undo your last move.",  
+        "Press 'Y' to redo a move you undid.",
+        "Press 'H' to show or hide a hint for the next move.",
         "Press 'R' to restart the level.", 
+        "Press 'F3' to show or hide frame timings, and 'F4' to save them as a trace.",
         "Yellow dice start the equation, Green dice have operators, and blue dice are the end of the equation.", 
         "The triangle and semi-circle symbols indicate a \"front\".",
         "When a dice is in a space that contains a front, instead of rolling off of that space, the die slides.",
@@ -117,13 +131,42 @@ class Game:
     def quit(self) -> None:
         self.running = False
 
-    # Unpause
+    # Unpause. Clearing the screen drops the pause buttons, and the main loop then redraws
+    # the whole level over the pause screen.
     def unpause(self) -> None:
         self.paused = False
         if self.state == "menu":
             self.render_menu()
         elif self.state in self.levels:
-            self.level_ui.render_all((0, 0))
+            self.clear_screen()
+
+    # Save the inputs that won the current level, for replaying. Nothing is saved if the
+    # working directory can't be written to.
+    def save_replay(self) -> None:
+        level_number = self.levels[self.state].number
+        path = os.path.join(self.REPLAY_DIR, time.strftime(f"level{level_number}-%Y%m%d-%H%M%S.json"))
+        try:
+            os.makedirs(self.REPLAY_DIR, exist_ok=True)
+            self.level_ui.replay().save(path)
+        except OSError as e:
+            print(f"Couldn't save replay to {path}: {e}")
+
+    # Show or hide the profiler overlay, clearing it off the screen when hidden
+    def toggle_profiler(self) -> None:
+        PROFILER.toggle()
+        if not PROFILER.enabled:
+            self.screen.fill(WHITE, PROFILER.overlay_rect(self.screen))
+            self.redraw_all = True
+
+    # Save the recorded frame timings as a Chrome trace in the working directory
+    def export_profile(self) -> None:
+        path = time.strftime("trace-%Y%m%d-%H%M%S.json")
+        try:
+            PROFILER.export(path)
+        except OSError as e:
+            print(f"Couldn't save trace to {path}: {e}")
+            return
+        print(f"Wrote {len(PROFILER.spans)} spans to {path}")
 
     # Render pause screen
     def render_pause(self) -> None:
@@ -157,44 +200,90 @@ class Game:
         # Run until the user asks to quit
         self.running = True
         while self.running:
+            PROFILER.start_frame()
             # Did the user click the window close button?
-            if self.level_ui.grid:
-                if self.level_ui.grid.won and not self.paused:
+            with PROFILER.phase("win check"):
+                if self.state in self.levels and self.level_ui.grid.won and not self.paused:
+                    self.save_replay()
                     self.render_winning()
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_ESCAPE:
-                        if not self.paused:
-                            self.render_pause()
-                        else:
-                            self.unpause()
-                    if self.state in self.levels and not self.paused:
-                        if event.key == pygame.K_u:
-                            self.level_ui.grid.undo()
-                        elif event.key == pygame.K_r:
-                            self.clear_screen()
-                            level_spec = self.levels[self.state]
-                            self.level_ui.load_level_spec(level_spec)
-                if event.type == pygame.MOUSEBUTTONDOWN and self.state in self.levels and not self.paused:
-                    self.level_ui.handle_click(pygame.mouse.get_pos())
-
-                for b in self.buttons:
-                    b.check_event(event)
+
+            # Sleep until something happens unless there is already something to draw. A hint
+            # search runs in another process and can't wake the loop, so poll for it instead.
+            # The profiler overlay is kept up to date the same way.
+            in_level = self.state in self.levels and not self.paused
+            events = pygame.event.get()
+            if not events and not self.redraw_all:
+                with PROFILER.phase("wait"):
+                    if in_level and self.level_ui.grid.hints.busy():
+                        events = [pygame.event.wait(self.HINT_POLL_MS)]
+                    elif PROFILER.enabled:
+                        events = [pygame.event.wait(self.PROFILER_MS)]
+                    else:
+                        events = [pygame.event.wait()]
+            if in_level:
+                self.level_ui.grid.poll_hint()
+
+            with PROFILER.phase("events"):
+                self.handle_events(events)
 
             for b in self.buttons:
                 b.update(self.screen)
 
+            # The level only redraws the triangles that changed, e.g. when the hovered cell changes
+            rects = []
             if self.state in self.levels and not self.paused:
-                self.clear_screen()
-                self.level_ui.render_all(pygame.mouse.get_pos())
+                rects = self.level_ui.render_all(pygame.mouse.get_pos(), self.redraw_all)
+            if PROFILER.enabled:
+                rects.append(PROFILER.render_overlay(self.screen))
 
             # Display the screen
-            pygame.display.update()
+            with PROFILER.phase("display"):
+                if self.redraw_all or self.buttons:
+                    pygame.display.update()
+                    self.redraw_all = False
+                elif rects:
+                    pygame.display.update(rects)
+            PROFILER.end_frame()
+
+            self.clock.tick(self.fps)
 
         # Done! Time to quit.
+        if self.level_ui.grid:
+            self.level_ui.grid.close()
         pygame.quit()
 
-Game().run()
+    # Handle the events that came in this frame
+    def handle_events(self, events: List[pygame.event.Event]) -> None:
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.running = False
+
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    if not self.paused:
+                        self.render_pause()
+                    else:
+                        self.unpause()
+                if event.key == pygame.K_F3:
+                    self.toggle_profiler()
+                elif event.key == pygame.K_F4:
+                    self.export_profile()
+                if self.state in self.levels and not self.paused:
+                    if event.key == pygame.K_u:
+                        self.level_ui.grid.undo()
+                    elif event.key == pygame.K_y:
+                        self.level_ui.grid.redo()
+                    elif event.key == pygame.K_h:
+                        self.level_ui.grid.toggle_hint()
+                    elif event.key == pygame.K_r:
+                        self.level_ui.grid.reset()
+            if event.type == pygame.MOUSEBUTTONDOWN and self.state in self.levels and not self.paused:
+                self.level_ui.handle_click(pygame.mouse.get_pos())
+
+            for b in self.buttons:
+                b.check_event(event)
+
+# Hint searches run in worker processes, which import this module again under the
+# spawn and forkserver start methods, so the game must only start when run directly
+if __name__ == '__main__':
+    Game().run()
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, NamedTuple, Optional
+
+from rules import Coord, Level
+from solver import count_solutions
+
+# Procedural levels by generate-and-test: random boards are built around an equation
+# that is known to work out, then kept only if the solver finds a solution that is
+# long enough and not one of too many.
+
+class GeneratorParams(NamedTuple):
+    width: int = 5
+    height: int = 5
+    dice: int = 3                       # a number die, dice-2 operator dice and an equals die
+    walls: int = 8
+    fronts: int = 0
+    operators: str = "+-x/"             # operators the operator dice may show
+    min_moves: int = 8                  # shortest solution must be at least this long
+    max_solutions: int = 10             # and there may be at most this many of that length
+    max_states: int = 200000            # give up on a candidate after searching this many states
+
+
+# Apply an operator the way the rules do, or None where the rules would give no value
+def _apply(op: str, value: int, operand: int) -> Optional[int]:
+    if op == '+':
+        return value + operand
+    if op == '-':
+        return value - operand
+    if op == 'x':
+        return value * operand
+    if value == 0:
+        return None
+    return value // operand
+
+
+# Four distinct faces: the one that makes the equation work and three decoys
+def _faces(rng: random.Random, face: str, decoy) -> List[str]:
+    faces = [face]
+    while len(faces) < 4:
+        d = decoy()
+        if d not in faces:
+            faces.append(d)
+    rng.shuffle(faces)
+    return faces
+
+
+# Build a random level spec around an equation that can be made, or None if the dice
+# don't fit on the board
+def random_spec(params: GeneratorParams, seed: int) -> Optional[dict]:
+    rng = random.Random(seed)
+    cells: List[Coord] = [(x, y, r) for x in range(params.width) for y in range(params.height) for r in range(2)]
+    if params.dice + params.walls + 1 > len(cells):
+        return None
+    rng.shuffle(cells)
+
+    # Work the equation out first so at least one set of top faces is valid
+    value = rng.randint(1, 9)
+    dice_faces = [_faces(rng, str(value), lambda: str(rng.randint(1, 9)))]
+    for _ in range(params.dice - 2):
+        while True:
+            op = rng.choice(params.operators)
+            operand = rng.randint(1, 5)
+            result = _apply(op, value, operand)
+            if result is not None:
+                break
+        value = result
+        dice_faces.append(_faces(rng, f"{op}{operand}", lambda: f"{rng.choice(params.operators)}{rng.randint(1, 5)}"))
+    dice_faces.append(_faces(rng, f"={value}", lambda: f"={value + rng.randint(-5, 5)}"))
+
+    objects = [{"type": "start", "loc": list(cells.pop())}]
+    objects.extend({"type": "wall", "loc": list(cells.pop())} for _ in range(params.walls))
+    objects.extend({"type": "d4", "loc": list(cells.pop()), "faces": faces} for faces in dice_faces)
+    weather = [{"type": "front", "loc": list(cells.pop())} for _ in range(min(params.fronts, len(cells)))]
+
+    spec = {"name": f"Generated {seed}", "dim": [params.width, params.height], "seed": seed, "objects": objects}
+    if weather:
+        spec["weather"] = weather
+    return spec
+
+
+# Generate one candidate and solve it, returning the spec with its optimal move count
+# if it is worth keeping, or None
+def candidate(params: GeneratorParams, seed: int) -> Optional[dict]:
+    spec = random_spec(params, seed)
+    if spec is None:
+        return None
+
+    (moves, solutions) = count_solutions(Level.from_spec(spec), params.max_states)
+    if moves is None or moves < params.min_moves or solutions > params.max_solutions:
+        return None
+    spec["optimal_moves"] = moves
+    return spec
+
+
+# Test candidates across worker processes until count levels are kept, yielding each
+# one as soon as it is found. Seeds are handed out in order, so a run is reproducible
+# up to which of the candidates in flight finish first.
+def generate(params: GeneratorParams, count: int, seed: int=0, jobs: Optional[int]=None, max_tries: Optional[int]=None):
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        workers = jobs or os.cpu_count() or 1
+        pending = set()
+        kept = 0
+        tries = 0
+        while kept < count:
+            while len(pending) < 2*workers and (max_tries is None or tries < max_tries):
+                pending.add(pool.submit(candidate, params, seed + tries))
+                tries += 1
+            if not pending:
+                return
+
+            (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                spec = future.result()
+                if spec is not None and kept < count:
+                    kept += 1
+                    yield spec
+        for future in pending:
+            future.cancel()
+
+
+if __name__ == '__main__':
+    defaults = GeneratorParams()
+    parser = argparse.ArgumentParser(description="Generate solvable levels into a directory.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--count", type=int, default=10, help="levels to keep")
+    parser.add_argument("--seed", type=int, default=0, help="first random seed")
+    parser.add_argument("--jobs", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--max-tries", type=int, help="give up after this many candidates")
+    for (field, default) in defaults._asdict().items():
+        parser.add_argument("--" + field.replace("_", "-"), type=type(default), default=default)
+    args = parser.parse_args()
+    params = GeneratorParams(**{field: getattr(args, field) for field in GeneratorParams._fields})
+    if params.dice < 2 or not params.operators or any(op not in "+-x/" for op in params.operators):
+        parser.error("need at least 2 dice and operators from +-x/")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    n = 0
+    for spec in generate(params, args.count, args.seed, args.jobs, args.max_tries):
+        n += 1
+        spec["level"] = n
+        path = os.path.join(args.out_dir, f"level{n}.json")
+        with open(path, "w") as f:
+            json.dump(spec, f, indent=4)
+        print(f"{path}: {spec['name']}, {spec['optimal_moves']} moves")
+    sys.exit(0 if n == args.count else 1)
@@ -1,43 +1,20 @@
-import numpy
 import math
 import pygame
 from game_object import *
 from styles import *
-from typing import Tuple, Set, List, Optional
+from typing import Dict, Tuple, Set, List, Optional
 
-from images import *
-
-class Direction:
-    X = 0
-    Y = 1
-    R = 2
-
-    @staticmethod
-    def left(direction: int) -> int:
-        return (direction + 2) % 3
-
-    @staticmethod
-    def right(direction: int) -> int:
-        return (direction + 1) % 3
-
-DIRECTIONS = [Direction.X, Direction.Y, Direction.R]
-
-
-class Move:
-    player_end: Tuple[int, int, int]
-    player_dir: int
-    dice_end: Optional[Tuple[int, int, int]]
-    dice_dir: Optional[int]
-
-    def __init__(self, p_end: Tuple[int, int, int], p_dir: int, d_end: Optional[Tuple[int, int, int]]=None, d_dir: Optional[int]=None):
-        self.player_end = p_end
-        self.player_dir = p_dir
-        self.dice_end = d_end
-        self.dice_dir = d_dir
+from rules import Coord, Delta, Direction, Evaluation, Level, Move, State, add_dir
+from sprites import MOVE, PUSH_BOTH, PUSH_LEFT, PUSH_RIGHT, SpriteAtlas
+from deadlocks import Deadlocks
+from hints import HintEngine
+from profiler import PROFILER, timed
+from replay import Action, REDO, RESTART, UNDO
 
 
 class Triangle:
     o: Object                           # object in the triangle
+    empty: Empty                        # the triangle's object whenever nothing is in it
 
     x: int                              # x-coordinate in the grid
     y: int                              # y-coordinate in the grid
@@ -46,18 +23,21 @@ class Triangle:
     screen: pygame.Surface              # pygame screen to render to
     left_corner: Tuple[float, float]    # pixel corner for the left corner of the triangle
     unit: float                         # pixel length of half of a triangle side
+    atlas: SpriteAtlas                  # sprites pre-scaled for unit
 
     front: bool                         # whether the triangle has a front
 
-    def __init__(self, x_loc: int, y_loc: int, rad: int, screen: pygame.Surface, left_corner: Tuple[float, float], unit: float):
-        self.o = Empty(x_loc, y_loc, rad)
+    def __init__(self, x_loc: int, y_loc: int, rad: int, screen: pygame.Surface, left_corner: Tuple[float, float], atlas: SpriteAtlas):
+        self.empty = Empty(x_loc, y_loc, rad)
+        self.o = self.empty
         self.x = x_loc
         self.y = y_loc
         self.r = rad
 
         self.screen = screen
         self.left_corner = left_corner
-        self.unit = unit
+        self.unit = atlas.unit
+        self.atlas = atlas
 
         self.front = False
 
@@ -69,6 +49,11 @@ class Triangle:
     def set_object(self, obj: Object) -> None:
         self.o = obj
 
+    # Empty the triangle if it holds the given object
+    def clear(self, obj: Object) -> None:
+        if self.o is obj:
+            self.o = self.empty
+
     # Set whether the triangle is a front
     def set_front(self, is_front: bool) -> None:
         self.front = is_front
@@ -81,106 +66,122 @@ class Triangle:
     def is_pushable(self) -> bool:
         return type(self.o) == Dice
 
-    # Move object in the given direction
-    def move_object(self, direction: int, player_direction: Optional[int]=None) -> None:
-        self.o.move(direction, self.front, player_direction)
+    # Check if the object in the triangle never changes during a level
+    def is_static(self) -> bool:
+        return type(self.o) == Wall
 
-    # Render the triangle
-    def render(self, arrow_direction: int, arrow_type: int, mouseover: bool) -> None:
+    # Render the parts of the triangle that never change onto the static layer
+    def render_static(self, surface: pygame.Surface) -> None:
         # Render front if it exists
         if self.front:
-            img = pygame.transform.scale(FRONT, (self.unit, self.unit/2))
-            self.screen.blit(img, (
+            surface.blit(self.atlas.front, (
                 self.left_corner[0] + self.unit/2,
                 self.left_corner[1] + (0.25 if self.r == 1 else -0.5)*math.sqrt(3)*self.unit
             ))
-            
-        self.o.render(self.screen, self.left_corner, self.unit)
-
-        # Determine arrow type
-        img = None
-        if arrow_type == 0:
-            if mouseover:
-                img = MOVE_ARROW_HOVER
-            else:
-                img = MOVE_ARROW
-        elif arrow_type == 1:
-            img = PUSH_ARROW_BOTH
-        elif arrow_type == 2:
-            img = pygame.transform.flip(PUSH_ARROW_RIGHT, True, False)
-        elif arrow_type == 3:
-            img = PUSH_ARROW_RIGHT
-
-        if img:
-            # Scale and rotate arrow image
-            img = pygame.transform.scale(img, (self.unit, self.unit/2))
-            rotation = 0
-            if arrow_direction == Direction.Y:
-                if self.r == 0:
-                    rotation = 180
-            elif arrow_direction == Direction.X:
-                if self.r == 0:
-                    rotation = 60
-                else:
-                    rotation = 240
-            elif arrow_direction == Direction.R:
-                if self.r == 0:
-                    rotation = 300
-                else:
-                    rotation = 120
 
-            if rotation > 0:
-                img = pygame.transform.rotate(img, rotation)
+        if self.is_static():
+            self.o.render(surface, self.left_corner, self.atlas)
 
-            # Move the arrow to the right position
-            x_offset = 0
-            y_offset = 0
+    # Get the screen area the triangle's object and arrow can draw into
+    def bounds(self) -> pygame.Rect:
+        top = self.left_corner[1] - (math.sqrt(3)*self.unit if self.r == 0 else 0)
+        return pygame.Rect(
+            math.floor(self.left_corner[0] - self.unit),
+            math.floor(top - self.unit),
+            math.ceil(4*self.unit) + 1,
+            math.ceil((math.sqrt(3) + 2)*self.unit) + 1
+        )
 
-            # Don't question the math here it's hell
-            if arrow_direction == Direction.Y:
-                if self.r == 0:
-                    x_offset = self.unit / 2
-                    y_offset = -self.unit / 2
-                else:
-                    x_offset = self.unit / 2
-            elif arrow_direction == Direction.X:
-                if self.r == 0:
-                    x_offset = self.unit / 4
-                    y_offset = -self.unit * 3 * math.sqrt(3) / 4
-                else:
-                    x_offset = self.unit * (5 - math.sqrt(3)) / 4
-                    y_offset = self.unit * (math.sqrt(3) - 1) / 4
-            elif arrow_direction == Direction.R:
-                if self.r == 0:
-                    x_offset = self.unit * (5 - math.sqrt(3)) / 4
-                    y_offset = -self.unit * 3 * math.sqrt(3) / 4
-                else:
-                    x_offset = self.unit / 4
-                    y_offset = self.unit * (math.sqrt(3) - 1) / 4
+    # Get what the rendered triangle looks like, to tell when it needs redrawing
+    def render_key(self, arrow_direction: int, arrow_type: int, mouseover: bool) -> tuple:
+        return (self.o.render_key(), int(arrow_direction), int(arrow_type), mouseover and arrow_type == MOVE)
+
+    # Render the triangle
+    @timed("triangles")
+    def render(self, arrow_direction: int, arrow_type: int, mouseover: bool) -> None:
+        if not self.is_static():
+            self.o.render(self.screen, self.left_corner, self.atlas)
 
+        # Draw the pre-rotated arrow for this direction and type, if any
+        arrow = self.atlas.arrow(arrow_direction, arrow_type, mouseover, self.r)
+        if arrow:
+            (img, (x_offset, y_offset)) = arrow
             self.screen.blit(img, (self.left_corner[0] + x_offset, self.left_corner[1] + y_offset))
 
 
 
+Arrow = Tuple[int, int]                 # (direction, arrow type) drawn in a triangle
+NO_ARROW: Arrow = (-1, -1)
+
+OVERLAP_STEPS = 6                       # most steps between triangles whose bounds overlap
+
+DieValues = Tuple[Tuple[int, Optional[int], Optional[bool]], ...]  # (die, value, validity) of some dice
+
+DEAD_END_TEXT = "This can't be won any more. Press U to undo or R to restart."
+
+
 class Grid:
     MARGIN: int = 200                   # pixel margin on the screen
 
-    grid: any                           # array of triangles representing the grid
+    triangles: List[Triangle]           # triangles representing the grid, indexed by flat cell id
 
     unit: float                         # unit length in pixels equal to half of a triangle side
     bl: Tuple[float, float]             # pixel coordinates for bottom left corner of the grid
     tl: Tuple[float, float]             # pixel coordinates for top left corner of the grid
     screen: pygame.Surface              # pygame screen to render to
     bgimage: pygame.Surface             # background image for grid
+    static_layer: pygame.Surface        # background, grid image, fronts and walls, composited once
+    drawn: Optional[dict]               # render key of every dynamic triangle on screen, None if nothing is
+    dirty: Set[Coord]                   # triangles whose objects changed since the last render
+    shown_arrows: Dict[Coord, Arrow]    # arrows on screen
+    shown_highlight: Set[Coord]         # highlighted triangles on screen
+    overlaps: Dict[Coord, List[Coord]]  # triangles whose bounds overlap each triangle's, worked out when first needed
+    atlas: SpriteAtlas                  # every sprite pre-scaled and pre-rotated for unit
     won = False
+    level: Level                        # rules for the level being played
+    state: State                        # current puzzle state; the objects below are views of it
+    evaluation: Evaluation              # dice values for the current state, updated only when it changes
+    start_evaluation: Evaluation        # dice values at the start, for restarting
     player: Player                      # Player object
-    undo_stack: List[Move]              # Stack of moves for undo purposes
-
-    def __init__(self, width: int, height: int, screen: pygame.Surface, bgimage: pygame.Surface):
+    dice: List[Dice]                    # Dice objects, in level order
+    undo_stack: List[Tuple[Delta, DieValues, bool]]     # what every move changed, the dice values it changed and whether it was won before
+    redo_stack: List[Move]              # undone moves, until a new move is made
+    inputs: List[Action]                # every input that changed the state since the level was loaded, for replays
+    zobrist: int                        # Zobrist hash of the current state, updated move by move
+    start_zobrist: int                  # Zobrist hash of the start, for restarting
+    deadlocks: Deadlocks                # dead-state check, run on every state change
+    suspects: Set[int]                  # dice that could make the current state dead, see Deadlocks.suspect
+    dead: bool                          # whether the current state is known to be lost
+    warning_rect: Optional[pygame.Rect] # where the dead-end warning is on screen, if it is
+    hints: HintEngine                   # background search for the next optimal move
+    show_hint: bool                     # whether to show the next optimal move
+    hint: Optional[Move]                # next optimal move from the current state, if shown and found
+    moves: Optional[List[Move]]         # legal moves from the current state, None until worked out
+    move_targets: Dict[Coord, Move]     # legal moves by the triangle that has to be clicked
+    arrows: Dict[Coord, Arrow]          # arrows drawn whatever the mouse is over
+    push_arrows: List[Tuple[Set[Coord], Dict[Coord, Arrow]]]    # push target arrows, shown while the mouse is over any of the cells
+
+    def __init__(self, level: Level, screen: pygame.Surface, bgimage: pygame.Surface, background: Optional[pygame.Surface]=None):
+        (width, height) = (level.width, level.height)
         self.screen = screen
-        self.grid = numpy.full((width, height, 2), None)
-        self.player = None
+        self.level = level
+        self.state = level.start
         self.undo_stack = []
+        self.redo_stack = []
+        self.inputs = []
+        self.drawn = None
+        self.dirty = set()
+        self.shown_arrows = dict()
+        self.shown_highlight = set()
+        self.overlaps = dict()
+        self.moves = None
+        self.deadlocks = Deadlocks(level)
+        self.suspects = set()
+        self.dead = False
+        self.warning_rect = None
+        self.hints = HintEngine(level, self.deadlocks)
+        self.show_hint = False
+        self.hint = None
 
         (screen_w, screen_h) = screen.get_size()
         (adj_w, adj_h) = (screen_w - self.MARGIN, screen_h - self.MARGIN)
@@ -195,19 +196,41 @@ class Grid:
         self.bl = ((screen_w - grid_w) / 2, (screen_h + grid_h) / 2)
 
         self.bgimage = pygame.transform.scale(bgimage, (grid_w, grid_h))
-
-        for i in range(width):
-            for j in range(height):
-                for r in range(2):
-                    self.grid[i, j, r] = Triangle(i, j, r, screen, self.grid_to_screen_coord(i, j, r), self.unit)
+        self.atlas = SpriteAtlas(self.unit)
+
+        self.triangles = [Triangle(*c, screen, self.grid_to_screen_coord(*c), self.atlas) for c in level.cells]
+
+        for (x, y, r) in level.walls:
+            self.set_object(Wall(x, y, r), x, y, r)
+        for (x, y, r) in level.fronts:
+            self.get_triangle(x, y, r).set_front(True)
+
+        self.player = Player(*self.state.player) if self.state.player else None
+        self.dice = [Dice(*loc, level.faces(i, o)) for (i, (loc, o)) in enumerate(self.state.dice)]
+        self.evaluation = level.evaluate(self.state)
+        self.start_evaluation = self.evaluation
+        self.start_zobrist = self.zobrist = level.zobrist(self.state)
+        self._sync_objects()
+        self._update_hint()
+
+        # Composite everything that stays put for the whole level
+        self.static_layer = pygame.Surface(screen.get_size(), 0, screen)
+        self.static_layer.fill(WHITE)
+        if background:
+            self.static_layer.blit(background, (0, 0))
+        self.static_layer.blit(self.bgimage, (self.tl[0], self.tl[1]))
+        for t in self.triangles:
+            t.render_static(self.static_layer)
 
     # Verify that the coordinates are in the grid, and raise an exception if not
     def _verify_coord(self, x: int, y: int, r: int, raise_if_bad: bool=True) -> bool:
-        if x < 0 or x >= self.grid.shape[0]:
+        if self.level.in_bounds(x, y, r):
+            return True
+        if x < 0 or x >= self.level.width:
             if raise_if_bad:
                 raise Exception(f"x coordinate {x} out of bounds")
             return False
-        if y < 0 or y >= self.grid.shape[1]:
+        if y < 0 or y >= self.level.height:
             if raise_if_bad:
                 raise Exception(f"y coordinate {y} out of bounds")
             return False
@@ -219,91 +242,107 @@ class Grid:
 
     # Get the coordinates shifted in that direction
     def _add_dir(self, x: int, y: int, r: int, d: int) -> Tuple[int, int, int]:
-        if d == Direction.R:
-            return (x, y, 1-r)
-
-        pm = 1 if r == 1 else -1
-        if d == Direction.X:
-            return (x+pm, y, 1-r)
-        if d == Direction.Y:
-            return (x, y+pm, 1-r)
+        return add_dir(x, y, r, d)
 
     # Get the dimensions of the grid
     def shape(self) -> Tuple[int, int]:
-        return (self.grid.shape[0], self.grid.shape[1])
+        return (self.level.width, self.level.height)
 
     # Get the triangle at the given coordinates
-    def get_triangle(self, x: int, y: int, r: int) -> Object:
+    def get_triangle(self, x: int, y: int, r: int) -> Triangle:
         self._verify_coord(x, y, r)
-        return self.grid[x, y, r]
+        return self.triangles[self.level.ids[(x, y, r)]]
 
     # Get the object at the given coordinates
     def get_object(self, x: int, y: int, r: int) -> Object:
         self._verify_coord(x, y, r)
-        return self.grid[x, y, r].get_object()
+        return self.get_triangle(x, y, r).get_object()
 
     # Set the object at the given coordinates
     def set_object(self, o: Object, x: int, y: int, r: int) -> None:
         self._verify_coord(x, y, r)
-        self.grid[x, y, r].set_object(o)
+        self.get_triangle(x, y, r).set_object(o)
 
     # Get the directions adjacent to the given coordinates
-    def grid_adj(self, x: int, y: int, r: int) -> Set[Direction]:
+    def grid_adj(self, x: int, y: int, r: int) -> List[int]:
         self._verify_coord(x, y, r)
-        adj: Set[Direction] = set()
-
-        for d in DIRECTIONS:
-            (x2, y2, r2) = self._add_dir(x, y, r, d)
-            if self._verify_coord(x2, y2, r2, False):
-                adj.add(d)
-        return adj
-
-    # Move an object at the given coordinates in the given direction
-    def move_object(self, x: int, y: int, r: int, d: int, player_d: Optional[int]=None, undo: bool=False) -> None:
-        self._verify_coord(x,y,r)
-        o = self.grid[x, y, r].get_object()
-
-        (x2, y2, r2) = self._add_dir(x, y, r, d)
-        self._verify_coord(x2, y2, r2)
-
-        # Can only move into empty spaces
-        if not self.grid[x2, y2, r2].is_empty():
-            raise Exception(f"Cannot move from ({x}, {y}, {r}) into nonempty space at ({x2}, {y2}, {r2})")
-        e = self.grid[x2, y2, r2].get_object()
-
-        # Move objects
-        if undo:
-            self.grid[x2, y2, r2].move_object(d)
-            self.grid[x, y, r].o.move(d, self.grid[x2, y2, r2].front, player_d)
-        else:
-            self.grid[x2, y2, r2].move_object(d)
-            self.grid[x, y, r].move_object(d, player_d)
-
-        # Set new objects to their locations
-        self.grid[x, y, r].set_object(e)
-        self.grid[x2, y2, r2].set_object(o)
-
-    # Add objects from level JSON
-    def add_objects(self, objects: any) -> None:
-        for o in objects:
-            (x, y, r) = o["loc"]
-            if o["type"] == "start":
-                self.player = Player(x, y, r)
-                self.set_object(self.player, x, y, r)
-            elif o["type"] == "d4":
-                d4 = Dice(x, y, r, o["faces"])
-                self.set_object(d4, x, y, r)
-            elif o["type"] == "wall":
-                wall = Wall(x, y, r)
-                self.set_object(wall, x, y, r)
-
-    # Set weather from level JSON
-    def set_weather(self, weather: any) -> None:
-        for w in weather:
-            (x, y, r) = w["loc"]
-            if w["type"] == "front":
-                self.grid[x, y, r].set_front(True)
+        return [d for (d, _) in self.level.neighbours(x, y, r)]
+
+    # Move to a state that differs from the current one by the player and at most one die,
+    # given its dice values and the dice whose values changed
+    def _restore(self, state: State, evaluation: Evaluation, die: int, changed: DieValues) -> None:
+        previous = self.state
+        self.evaluation = evaluation
+        self.state = state
+        self.moves = None
+
+        # Take the player and the die off the triangles they left before putting them
+        # down, since the player can step onto the die's old triangle
+        if self.player:
+            self.get_triangle(*previous.player).clear(self.player)
+        if die >= 0:
+            self.get_triangle(*previous.dice[die][0]).clear(self.dice[die])
+        if self.player:
+            self.player.set_location(*state.player)
+            self.set_object(self.player, *state.player)
+            self.dirty.update((previous.player, state.player))
+        if die >= 0:
+            self._place_die(die)
+            self.dirty.update((previous.dice[die][0], state.dice[die][0]))
+            if self.deadlocks.suspect(die, *state.dice[die]):
+                self.suspects.add(die)
+            else:
+                self.suspects.discard(die)
+
+        for (i, _, _) in changed:
+            self.dice[i].set_value(evaluation.values[i], evaluation.valid[i])
+            self.dirty.add(state.dice[i][0])
+        self.won = evaluation.won
+        self._update_hint()
+
+    # Make a legal move, recording what it changes so it can be undone
+    def make_move(self, m: Move) -> None:
+        delta = self.level.delta(self.state, m)
+        state = self.level.step(self.state, m)
+        before = self.evaluation
+        with PROFILER.phase("propagation"):
+            (evaluation, recalculated) = self.level.reevaluate_dice(state, self.state, before)
+
+        # Only the dice values the move changed are kept for undoing it
+        changed = tuple(
+            (i, before.values[i], before.valid[i]) for i in recalculated
+            if evaluation.values[i] != before.values[i] or evaluation.valid[i] != before.valid[i]
+        )
+        self.undo_stack.append((delta, changed, before.won))
+        self.zobrist = self.level.rehash(self.zobrist, delta, state)
+        self._restore(state, evaluation, delta.die, changed)
+
+    # Put die i where the rules state says it is, showing its faces for its orientation
+    def _place_die(self, i: int) -> None:
+        (loc, o) = self.state.dice[i]
+        self.dice[i].set_location(*loc)
+        self.dice[i].set_faces(self.level.faces(i, o))
+        self.set_object(self.dice[i], *loc)
+
+    # Place the player and every die object where the rules state says they are
+    def _sync_objects(self) -> None:
+        for o in [self.player] + self.dice:
+            if o:
+                self.get_triangle(*o.get_location()).clear(o)
 
+        if self.player:
+            self.player.set_location(*self.state.player)
+            self.set_object(self.player, *self.state.player)
+        for i in range(len(self.dice)):
+            self._place_die(i)
+
+        for (d, value, valid) in zip(self.dice, self.evaluation.values, self.evaluation.valid):
+            d.set_value(value, valid)
+        self.won = self.evaluation.won
+        self.suspects = {i for (i, (loc, o)) in enumerate(self.state.dice) if self.deadlocks.suspect(i, loc, o)}
+
+        # Anything may have moved, so the next render redraws everything
+        self.drawn = None
 
     # Convert grid coordinates to pixel coordinates
     def grid_to_screen_coord(self, x: int, y: int, r: int) -> Tuple[float, float]:
@@ -314,6 +353,11 @@ class Grid:
         else:
             return (rhombus_bl[0] + self.unit, rhombus_bl[1] - math.sqrt(3)*self.unit)
 
+    # Get the pixel coordinates of the centre of a triangle
+    def triangle_centre(self, x: int, y: int, r: int) -> Tuple[float, float]:
+        (corner_x, corner_y) = self.grid_to_screen_coord(x, y, r)
+        return (corner_x + self.unit, corner_y + (-1 if r == 0 else 1)*math.sqrt(3)*self.unit/3)
+
     # Convert pixel coordinates to grid coordinates
     def screen_to_grid_coord(self, coordinates: Tuple[float, float]) -> Tuple[int, int, int]:
         # Find the grid coordinates of the mouse
@@ -326,6 +370,56 @@ class Grid:
         r = 0 if grid_x + grid_y < x + y + 1 else 1
         return (x, y, r)
 
+    # Get the legal moves from the current state. The table and the arrows showing it are
+    # only worked out again after the state changes.
+    @timed("arrows")
+    def legal_moves(self) -> List[Move]:
+        if self.moves is None:
+            self.moves = self.level.legal_moves(self.state)
+            self.move_targets = dict()
+            for m in self.moves:
+                self.move_targets.setdefault(m.target(), m)
+            self._build_arrows()
+        return self.moves
+
+    # Work out the arrows for the current legal moves
+    def _build_arrows(self) -> None:
+        self.arrows = dict()
+        self.push_arrows = []
+
+        # Can move to empty triangles
+        pushes: Dict[Coord, List[Move]] = dict()
+        for m in self.moves:
+            if m.dice_end is None:
+                self.arrows[m.player_end] = (m.player_dir, MOVE)
+            else:
+                pushes.setdefault(m.player_end, []).append(m)
+
+        # Blue if you can push, pointing whichever ways around the die it can go
+        for (die, die_moves) in pushes.items():
+            d = die_moves[0].player_dir
+            dirs = {m.dice_dir for m in die_moves}
+            if len(dirs) == 2:
+                self.arrows[die] = (d, PUSH_BOTH)
+            elif Direction.left(d) in dirs:
+                self.arrows[die] = (d, PUSH_LEFT)
+            else:
+                self.arrows[die] = (d, PUSH_RIGHT)
+
+            # Where the die can go is shown while mousing over it or the triangles next to it
+            hover = {die} | {adj for (_, adj) in self.level.neighbours(*die) if adj != self.state.player}
+            self.push_arrows.append((hover, {m.dice_end: (m.dice_dir, MOVE) for m in die_moves}))
+
+    # Get the arrow in every triangle that has one, for the given mouse location
+    def arrows_at(self, mouse: Coord) -> Dict[Coord, Arrow]:
+        self.legal_moves()
+        arrows = self.arrows
+        for (hover, targets) in self.push_arrows:
+            if mouse in hover:
+                arrows = dict(arrows)
+                arrows.update(targets)
+        return arrows
+
     # Handle mouse click
     def handle_click(self, mouse_pos: Tuple[float, float]) -> None:
         # Check that the mouse is in the grid
@@ -334,147 +428,183 @@ class Grid:
             return
 
         # Check if click location is a valid move location
-        player_location = self.player.get_location()
-        if self.player:
-            for d in self.grid_adj(*player_location):
-                # Find all adjacent triangles
-                adj = self._add_dir(*player_location, d)
-
-                # Can move to empty triangles
-                if clicked == adj and self.grid[adj].is_empty():
-                    self.move_object(*player_location, d)
-                    self.undo_stack.append(Move(adj, d))
-                    return
-
-                # Can maybe move to pushable triangles
-                elif self.grid[adj].is_pushable():
-                    # Check adjacent triangles to the triangle you're pushing
-                    for adj_d in self.grid_adj(*adj):
-                        adj_adj = self._add_dir(*adj, adj_d)
-                        if adj_adj == player_location:
-                            continue
-
-                        # Can only push to empty triangles
-                        if clicked == adj_adj and self.grid[adj_adj].is_empty():
-                            # First move pushable object
-                            self.move_object(*adj, adj_d, d)
-                            # Then move player
-                            self.move_object(*player_location, d)
-
-                            self.undo_stack.append(Move(adj, d, adj_adj, adj_d))
-                            return
-
-    # Render the grid
-    def render_all(self, mouse_pos: Tuple[float, float]) -> None:
-        (grid_x, grid_y) = self.shape()
-
-        # Render background
-        self.screen.blit(self.bgimage, (self.tl[0], self.tl[1]))
-
+        self.legal_moves()
+        m = self.move_targets.get(clicked)
+        if m:
+            self.redo_stack.clear()
+            self.make_move(m)
+            self.inputs.append(clicked)
+
+    # Render the grid, redrawing only the triangles that changed since the last call unless
+    # full is set, and return the screen areas that were drawn
+    @timed("grid render")
+    def render_all(self, mouse_pos: Tuple[float, float], full: bool=False) -> List[pygame.Rect]:
         # Get player mouse coordinates
-        (mouse_x, mouse_y, mouse_r) = self.screen_to_grid_coord(mouse_pos)
-
-        # Arrow grid based on player movement options: arrows are represented by (direction, type)
-        arrow_grid = numpy.full([grid_x, grid_y, 2, 2], [-1, -1])
-        if self.player:
-            for d in self.grid_adj(*self.player.get_location()):
-                # Find all adjacent triangles
-                adj = self._add_dir(*self.player.get_location(), d)
-
-                # Can move to empty triangles
-                if self.grid[adj].is_empty():
-                    arrow_grid[adj] = [d, 0]
-
-                # Can maybe move to pushable triangles
-                elif self.grid[adj].is_pushable():
-                    # Check whether you're mousing over the pushabale triangle or any of its adjacent triangles
-                    moused_over = adj == (mouse_x, mouse_y, mouse_r)
-                    if not moused_over:
-                        for adj_d in self.grid_adj(*adj):
-                            adj_adj = self._add_dir(*adj, adj_d)
-                            if adj_adj == self.player.get_location():
-                                continue
-                                
-                            if adj_adj == (mouse_x, mouse_y, mouse_r):
-                                moused_over = True
-
-                    # Check adjacent triangles to the triangle you're pushing
-                    can_push_left = False
-                    left_dir = Direction.left(d)
-                    adj_left = self._add_dir(*adj, left_dir)
-                    if self._verify_coord(*adj_left, False) and self.grid[adj_left].is_empty():
-                        can_push_left = True
-                        if moused_over:
-                            arrow_grid[adj_left] = [left_dir, 0]
-
-                    can_push_right = False
-                    right_dir = Direction.right(d)
-                    adj_right = self._add_dir(*adj, right_dir)
-                    if self._verify_coord(*adj_right, False) and self.grid[adj_right].is_empty():
-                        can_push_right = True
-                        if moused_over:
-                            arrow_grid[adj_right] = [right_dir, 0]
-
-                    # Blue if you can push.
-                    if can_push_left and can_push_right:
-                        arrow_grid[adj] = [d, 1]
-                    elif can_push_left:
-                        arrow_grid[adj] = [d, 2]
-                    elif can_push_right:
-                        arrow_grid[adj] = [d, 3]
-
-        # Reset dice values
-        for x in range(grid_x):
-            for y in range(grid_y):
-                for r in range(2):
-                    self.grid[x, y, r].o.reset_value()
-
-        # Calculate dice values
-        used = set()
-        for x in range(grid_x):
-            for y in range(grid_y):
-                for r in range(2):
-                    if (x, y, r) in used:
-                        continue
-
-                    v = self.grid[x, y, r].o.calc_value()
-                    if v is not None:
-                        self.proprogate_values((x, y, r), v, used)
-
-        # Check if won
-        won = True
-        for x in range(grid_x):
-            for y in range(grid_y):
-                for r in range(2):
-                    if not self.grid[x, y, r].o.validate():
-                        won = False
-        self.won = won
-        # Render triangles
-        for x in range(grid_x):
-            for y in range(grid_y):
-                for r in range(2):
-                    self.grid[x, y, r].render(*arrow_grid[x, y, r], (x, y, r) == (mouse_x, mouse_y, mouse_r))
-
-    def proprogate_values(self, coordinates: Tuple[int, int, int], value: int, used: set) -> None:
-        used.add(coordinates)
-        for adj_dir in self.grid_adj(*coordinates):
-            adj = self._add_dir(*coordinates, adj_dir)
-            if adj in used:
-                continue
-
-            v = self.grid[adj].o.calc_value(value)
-            if v is not None:
-                self.proprogate_values(adj, v, used)
-
+        mouse = self.screen_to_grid_coord(mouse_pos)
+        arrows = self.arrows_at(mouse)
+
+        # The hinted move's arrow is drawn highlighted, as if moused over
+        highlight = {mouse}
+        if self.hint:
+            target = self.hint.target()
+            arrows = dict(arrows)
+            arrows[target] = (self.hint.player_dir if self.hint.dice_end is None else self.hint.dice_dir, MOVE)
+            highlight.add(target)
+
+        if full or self.drawn is None:
+            # Render background, grid image, fronts and walls, then every triangle holding the
+            # player, a die or an arrow in grid order
+            dynamic = {o.get_location() for o in [self.player] + self.dice if o}
+            dynamic.update(arrows)
+            self.drawn = {c: self._render_key(c, arrows, highlight) for c in dynamic}
+            self.screen.blit(self.static_layer, (0, 0))
+            for c in sorted(self.drawn):
+                self.get_triangle(*c).render(*arrows.get(c, NO_ARROW), c in highlight)
+            self._shown(arrows, highlight)
+            self.warning_rect = None
+            self._render_warning()
+            return [self.screen.get_rect()]
+
+        # Only triangles whose objects, arrow or highlight changed can look different
+        candidates = self.dirty | self.shown_highlight | highlight
+        if arrows is not self.shown_arrows:
+            shown = self.shown_arrows
+            candidates.update(c for c in arrows.keys() | shown.keys() if arrows.get(c) != shown.get(c))
+        changed = []
+        for c in candidates:
+            key = self._render_key(c, arrows, highlight)
+            if key != self.drawn.get(c):
+                changed.append(c)
+                if key is None:
+                    del self.drawn[c]
+                else:
+                    self.drawn[c] = key
+        self._shown(arrows, highlight)
+
+        # Redraw the area around every triangle that changed, from the static layer up
+        rects = [self.get_triangle(*c).bounds() for c in changed]
+        for (c, rect) in zip(changed, rects):
+            self.screen.set_clip(rect)
+            self.screen.blit(self.static_layer, rect, rect)
+            for o in self._overlapping(c):
+                if o in self.drawn:
+                    self.get_triangle(*o).render(*arrows.get(o, NO_ARROW), o in highlight)
+        self.screen.set_clip(None)
+
+        # Show or clear the dead-end warning, and put it back over any triangle redrawn under it
+        if self.dead != (self.warning_rect is not None):
+            if self.warning_rect:
+                rects.append(self.warning_rect)
+                self.screen.blit(self.static_layer, self.warning_rect, self.warning_rect)
+                self.warning_rect = None
+            self._render_warning()
+            if self.warning_rect:
+                rects.append(self.warning_rect)
+        elif self.warning_rect and self.warning_rect.collidelist(rects) >= 0:
+            self._render_warning()
+        return rects
+
+    # Get what a triangle looks like with the given arrows and highlights, or None if it
+    # shows nothing beyond the static layer
+    def _render_key(self, c: Coord, arrows: Dict[Coord, Arrow], highlight: Set[Coord]) -> Optional[tuple]:
+        if not self.level.in_bounds(*c):
+            return None
+        t = self.get_triangle(*c)
+        if c not in arrows and (t.is_empty() or t.is_static()):
+            return None
+        return t.render_key(*arrows.get(c, NO_ARROW), c in highlight)
+
+    # Remember what was just drawn, for telling what changes next frame
+    def _shown(self, arrows: Dict[Coord, Arrow], highlight: Set[Coord]) -> None:
+        self.dirty = set()
+        self.shown_arrows = arrows
+        self.shown_highlight = highlight
+
+    # Get the triangles whose bounds overlap the given triangle's, in grid order. Bounds are
+    # a fixed box around each triangle, so only triangles a few steps away can reach into it:
+    # up to OVERLAP_STEPS steps, since the box also reaches two rows up and down.
+    def _overlapping(self, c: Coord) -> List[Coord]:
+        if c not in self.overlaps:
+            rect = self.get_triangle(*c).bounds()
+            seen = {c}
+            frontier = {c}
+            for _ in range(OVERLAP_STEPS):
+                frontier = {adj for f in frontier for (_, adj) in self.level.neighbours(*f) if adj not in seen}
+                seen.update(frontier)
+            self.overlaps[c] = sorted(o for o in seen if self.get_triangle(*o).bounds().colliderect(rect))
+        return self.overlaps[c]
+
+    # Draw the dead-end warning above the grid if the state is lost
+    def _render_warning(self) -> None:
+        if not self.dead:
+            return
+        text = render_glyph(DEAD_END_TEXT, 32, RED, False)
+        self.warning_rect = self.screen.blit(text, (self.tl[0], max(0, self.tl[1] - self.MARGIN/4 - text.get_height())))
 
     # Undo last move
-    def undo(self):
+    def undo(self) -> None:
         if len(self.undo_stack) > 0:
-            m = self.undo_stack.pop()
-            self.move_object(*m.player_end, m.player_dir, undo=True)
-            if m.dice_end:
-                self.move_object(*m.dice_end, m.dice_dir, 3 - m.dice_dir - m.player_dir, undo=True)
-
-    # Reset puzzle
-    def reset(self):
-        pass
+            (delta, changed, won) = self.undo_stack.pop()
+            self.redo_stack.append(delta.move)
+            self.inputs.append(UNDO)
+            self.zobrist = self.level.rehash(self.zobrist, delta, self.state)
+
+            # Put back the dice values the move changed
+            values = list(self.evaluation.values)
+            valid = list(self.evaluation.valid)
+            for (i, value, ok) in changed:
+                values[i] = value
+                valid[i] = ok
+            evaluation = Evaluation(tuple(values), tuple(valid), won)
+            self._restore(self.level.revert(self.state, delta), evaluation, delta.die, changed)
+
+    # Redo the last undone move
+    def redo(self) -> None:
+        if len(self.redo_stack) > 0:
+            self.make_move(self.redo_stack.pop())
+            self.inputs.append(REDO)
+
+    # Reset puzzle to the starting state and its cached dice values
+    def reset(self) -> None:
+        self.inputs.append(RESTART)
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.evaluation = self.start_evaluation
+        self.state = self.level.start
+        self.zobrist = self.start_zobrist
+        self.moves = None
+        self._sync_objects()
+        self._update_hint()
+
+    # Show or hide the next optimal move
+    def toggle_hint(self) -> None:
+        self.show_hint = not self.show_hint
+        if not self.show_hint:
+            self.hints.cancel()
+        self._update_hint()
+
+    # Look up what is known about the current state: whether it is lost, by the dead-state
+    # check or a finished hint search, and the hint, searching for it in the background if
+    # it isn't known yet. A search from an earlier
+    # state is dropped.
+    def _update_hint(self) -> None:
+        if self.show_hint:
+            self.hints.request(self.state, self.zobrist)
+            self.hint = self.hints.hint(self.zobrist)
+        else:
+            self.hint = None
+        self.dead = (
+            bool(self.suspects) and self.deadlocks.is_dead(self.state, self.suspects)
+            or self.hints.has_hint(self.zobrist) and self.hints.hint(self.zobrist) is None
+        )
+
+    # Pick up a hint the background search has found. Returns whether there was one.
+    def poll_hint(self) -> bool:
+        if not self.hints.poll():
+            return False
+        self._update_hint()
+        return True
+
+    # Stop any background work
+    def close(self) -> None:
+        self.hints.cancel()
@@ -0,0 +1,108 @@
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional, Set, Tuple
+
+from deadlocks import Deadlocks
+from rules import Level, Move, State
+from solver import search
+
+# Next-move hints, searched for in a separate process so a deep search never holds up
+# the frame loop. Solutions are cached by Zobrist hash for every state along them, so
+# following a hint gives the next one straight away.
+
+MAX_STATES = 500_000                    # states a hint search may visit before giving up
+
+
+# Worker process: search from a packed state and send back the optimal moves, or None,
+# and whether the search finished
+def _solve(level: Level, key: int, conn: Connection) -> None:
+    result = search(level, max_states=MAX_STATES, start=level.unpack(key))
+    conn.send((result.moves, result.complete))
+    conn.close()
+
+
+class HintEngine:
+    level: Level
+    deadlocks: Deadlocks                # answers for dead states without searching
+    cache: Dict[int, Optional[Move]]    # Zobrist hash -> next optimal move, None if the state can't be won
+    gave_up: Set[int]                   # Zobrist hashes of states whose search ran out of states
+    searching: Optional[State]          # state the worker is searching from, if any
+    _process: Optional[multiprocessing.Process]
+    _conn: Optional[Connection]
+
+    def __init__(self, level: Level, deadlocks: Deadlocks):
+        self.level = level
+        self.deadlocks = deadlocks
+        self.cache = dict()
+        self.gave_up = set()
+        self.searching = None
+        self._process = None
+        self._conn = None
+
+    # Check whether a hint is known for the state with the given Zobrist hash
+    def has_hint(self, key: int) -> bool:
+        return key in self.cache
+
+    # Get the next optimal move from the state with the given Zobrist hash, if it has been found
+    def hint(self, key: int) -> Optional[Move]:
+        return self.cache.get(key)
+
+    # Start searching from a state, given its Zobrist hash, unless its hint is already
+    # known or being searched for. Any other search is cancelled, since its result can't
+    # be shown any more.
+    def request(self, state: State, key: int) -> None:
+        if self.has_hint(key) or key in self.gave_up or state == self.searching:
+            return
+        self.cancel()
+        if self.level.is_won(state):
+            return
+        if self.deadlocks.is_dead(state):
+            self.cache[key] = None
+            return
+
+        (self._conn, child) = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(target=_solve, args=(self.level, self.level.pack(state), child), daemon=True)
+        self._process.start()
+        child.close()
+        self.searching = state
+
+    # Collect the result of a finished search without blocking. Returns whether a new
+    # hint came in.
+    def poll(self) -> bool:
+        if self._conn is None or not self._conn.poll():
+            return False
+        try:
+            result: Tuple[Optional[List[Move]], bool] = self._conn.recv()
+        except EOFError:
+            self.cancel()
+            return False
+
+        (moves, complete) = result
+        state = self.searching
+        self.cancel()
+        if moves is None:
+            # Only a search that finished shows the state can't be won
+            if complete:
+                self.cache[self.level.zobrist(state)] = None
+            else:
+                self.gave_up.add(self.level.zobrist(state))
+            return True
+        for m in moves:
+            self.cache[self.level.zobrist(state)] = m
+            state = self.level.step(state, m)
+        return True
+
+    # Check whether a search is running
+    def busy(self) -> bool:
+        return self._process is not None
+
+    # Stop the running search, if any
+    def cancel(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self.searching = None
@@ -1,30 +1,86 @@
+import os
+import threading
+from typing import Dict, List, Tuple
+
 import pygame
 
-WALL_IMG = pygame.image.load('images/wall.png')
-PLAYER_IMG_0 = pygame.image.load('images/player_still_0.png')
-PLAYER_IMG_1 = pygame.image.load('images/player_still_1.png')
-MOVE_ARROW = pygame.image.load('images/move_arrow.png')
-MOVE_ARROW_HOVER = pygame.image.load('images/move_arrow_hover.png')
-PUSH_ARROW_RIGHT = pygame.image.load('images/push_arrow_right.png')
-PUSH_ARROW_RIGHT_HOVER = pygame.image.load('images/push_arrow_right_hover.png')
-PUSH_ARROW_BOTH = pygame.image.load('images/push_arrow_both.png')
-PUSH_ARROW_BOTH_HOVER = pygame.image.load('images/push_arrow_both_hover.png')
-D4_RED_IMG = pygame.image.load('images/d4.png')
-D4_BLUE_IMG = pygame.image.load('images/d4blue.png') 
-D4_GREEN_IMG = pygame.image.load('images/d4green.png') 
-D4_YELLOW_IMG = pygame.image.load('images/d4yellow.png') 
-FRONT = pygame.image.load('images/front.png')
-LEVEL = [pygame.image.load('images/level1.png'),
-         pygame.image.load('images/level2.png'),
-         pygame.image.load('images/level3.png'),
-         pygame.image.load('images/level4.png'),
-         pygame.image.load('images/level5.png'),
-         pygame.image.load('images/level6.png'),
-         pygame.image.load('images/level7.png')]
-LEVEL_BG = [pygame.image.load('images/level1_bg.png'),
-            pygame.image.load('images/level2_bg.png'),
-            pygame.image.load('images/level1_bg.png'),
-            pygame.image.load('images/level2_bg.png'),
-            pygame.image.load('images/level1_bg.png'),
-            pygame.image.load('images/level2_bg.png'),
-            pygame.image.load('images/level1_bg.png')]
+# Image assets. Nothing is loaded at import time: every file is loaded the first time
+# it is used, only once however many names refer to it, and converted to the
+# display's pixel format so blits don't convert pixels on the fly. Load images after
+# the display has been set up; anything loaded before then stays unconverted, since
+# sprites are cached by the identity of their source image.
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+
+# Sprites by the name code refers to them as, e.g. images.WALL_IMG
+SPRITES = {
+    "WALL_IMG": "wall.png",
+    "PLAYER_IMG_0": "player_still_0.png",
+    "PLAYER_IMG_1": "player_still_1.png",
+    "MOVE_ARROW": "move_arrow.png",
+    "MOVE_ARROW_HOVER": "move_arrow_hover.png",
+    "PUSH_ARROW_RIGHT": "push_arrow_right.png",
+    "PUSH_ARROW_RIGHT_HOVER": "push_arrow_right_hover.png",
+    "PUSH_ARROW_BOTH": "push_arrow_both.png",
+    "PUSH_ARROW_BOTH_HOVER": "push_arrow_both_hover.png",
+    "D4_RED_IMG": "d4.png",
+    "D4_BLUE_IMG": "d4blue.png",
+    "D4_GREEN_IMG": "d4green.png",
+    "D4_YELLOW_IMG": "d4yellow.png",
+    "FRONT": "front.png",
+}
+
+# Grid image and background of every level, by level index
+LEVEL_ART = ["level1.png", "level2.png", "level3.png", "level4.png", "level5.png", "level6.png", "level7.png"]
+LEVEL_BACKGROUNDS = ["level1_bg.png", "level2_bg.png", "level1_bg.png", "level2_bg.png", "level1_bg.png", "level2_bg.png", "level1_bg.png"]
+OPAQUE = set(LEVEL_BACKGROUNDS)         # files without transparency, which blit faster without an alpha channel
+
+_cache: Dict[str, pygame.Surface] = dict()
+_locks: Dict[str, threading.Lock] = dict()
+_locks_lock = threading.Lock()
+
+
+# Get an image file's surface, loading it the first time. Safe to call from a
+# background thread; a file being loaded by one thread is waited for by the others.
+def load(filename: str) -> pygame.Surface:
+    surface = _cache.get(filename)
+    if surface is not None:
+        return surface
+    with _locks_lock:
+        lock = _locks.setdefault(filename, threading.Lock())
+    with lock:
+        if filename not in _cache:
+            surface = pygame.image.load(os.path.join(IMAGE_DIR, filename))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert() if filename in OPAQUE else surface.convert_alpha()
+            _cache[filename] = surface
+    return _cache[filename]
+
+
+# Get the grid image and background of a level. Levels past the last one with art of
+# its own take turns reusing it.
+def level_art(index: int) -> Tuple[pygame.Surface, pygame.Surface]:
+    index %= len(LEVEL_ART)
+    return (load(LEVEL_ART[index]), load(LEVEL_BACKGROUNDS[index]))
+
+
+# Start loading a level's art in a background thread, so it is ready when the level is
+# picked. Does nothing if it is already loaded.
+def preload_level(index: int) -> None:
+    index %= len(LEVEL_ART)
+    if LEVEL_ART[index] not in _cache or LEVEL_BACKGROUNDS[index] not in _cache:
+        threading.Thread(target=level_art, args=(index,), daemon=True).start()
+
+
+# Sprites are looked up by name on first use, then kept as module attributes
+def __getattr__(name: str) -> pygame.Surface:
+    if name not in SPRITES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    surface = load(SPRITES[name])
+    globals()[name] = surface
+    return surface
+
+
+# Names of every sprite, for completion and dir()
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(SPRITES))
@@ -0,0 +1,215 @@
+import io
+import os
+import sys
+import json
+import zlib
+import struct
+import hashlib
+import argparse
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+from rules import Level
+
+# Compiled level packs. A pack starts with an index of every level's name, number and
+# where its spec is stored, followed by the specs themselves as compressed JSON.
+# Opening a pack reads just the index; a level is decoded and checked only when it is
+# asked for, so start-up time and memory don't grow with the size of the pack.
+#
+# Layout, little-endian:
+#   header  magic "TBLP", format version (u16), level count (u32), source fingerprint (u64)
+#   index   per level: number (u32), offset (u64), length (u32), crc32 (u32),
+#           name length (u16), UTF-8 name
+#   data    the compressed specs, at their offsets from the start of the file
+#
+# A levels directory of JSON files gets a pack compiled from them as a cache. The
+# fingerprint of the files it was compiled from is stored in the header, and the pack
+# is compiled again whenever a file is added, removed or modified.
+
+MAGIC = b"TBLP"
+FORMAT_VERSION = 1
+PACK_NAME = "levels.pack"               # cache file in a levels directory
+
+_HEADER = struct.Struct("<4sHIQ")
+_ENTRY = struct.Struct("<IQIIH")
+
+
+class PackEntry(NamedTuple):
+    name: str
+    number: int                         # the level's "level" field, its place in the menu
+    offset: int                         # where its compressed spec starts in the pack
+    length: int                         # compressed length in bytes
+    crc: int                            # crc32 of the compressed spec
+
+
+class LevelPack:
+    entries: Dict[str, PackEntry]       # every level by name, in level order
+    fingerprint: int                    # fingerprint of the source files, 0 if there weren't any
+    _file: BinaryIO
+
+    def __init__(self, f: BinaryIO):
+        self._file = f
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("Level pack is truncated")
+        (magic, version, count, self.fingerprint) = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not a level pack")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Level pack format {version} is not supported")
+
+        self.entries = dict()
+        for _ in range(count):
+            raw = f.read(_ENTRY.size)
+            if len(raw) < _ENTRY.size:
+                raise ValueError("Level pack is truncated")
+            (number, offset, length, crc, name_length) = _ENTRY.unpack(raw)
+            name = f.read(name_length).decode("utf-8")
+            self.entries[name] = PackEntry(name, number, offset, length, crc)
+
+    @staticmethod
+    def open(path: str) -> "LevelPack":
+        f = open(path, "rb")
+        try:
+            return LevelPack(f)
+        except ValueError:
+            f.close()
+            raise
+
+    def close(self) -> None:
+        self._file.close()
+
+    # Decode a level's spec, checking it is intact
+    def spec(self, name: str) -> dict:
+        entry = self.entries[name]
+        self._file.seek(entry.offset)
+        data = self._file.read(entry.length)
+        if len(data) != entry.length or zlib.crc32(data) != entry.crc:
+            raise ValueError(f"Level {name!r} is corrupt in the pack")
+        spec = json.loads(zlib.decompress(data))
+        if spec.get("name") != name or spec.get("level") != entry.number:
+            raise ValueError(f"Level {name!r} doesn't match its index entry")
+        return spec
+
+
+# Check that the game could load a spec, raising ValueError if not
+def _check(spec: dict) -> None:
+    if not isinstance(spec, dict):
+        raise ValueError("Level is not a JSON object")
+    for field in ("name", "level", "dim"):
+        if field not in spec:
+            raise ValueError(f"Level has no {field!r}")
+    if not isinstance(spec["level"], int) or not 0 <= spec["level"] < 2**32:
+        raise ValueError(f"Level number {spec['level']!r} is not valid")
+    try:
+        Level.from_spec(spec)
+    except (KeyError, IndexError, TypeError) as e:
+        raise ValueError(f"Level {spec['name']!r} is malformed: {e!r}") from e
+
+
+# Build a pack from level specs, ordered by level number
+def compile_pack(specs: List[dict], fingerprint: int=0) -> bytes:
+    for spec in specs:
+        _check(spec)
+    specs = sorted(specs, key=lambda spec: spec["level"])
+    names = set()
+    blobs = []
+    for spec in specs:
+        if spec["name"] in names:
+            raise ValueError(f"Two levels are named {spec['name']!r}")
+        names.add(spec["name"])
+        blobs.append(zlib.compress(json.dumps(spec, separators=(",", ":")).encode("utf-8")))
+
+    encoded = [spec["name"].encode("utf-8") for spec in specs]
+    offset = _HEADER.size + sum(_ENTRY.size + len(name) for name in encoded)
+    out = io.BytesIO()
+    out.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(specs), fingerprint))
+    for (spec, name, blob) in zip(specs, encoded, blobs):
+        out.write(_ENTRY.pack(spec["level"], offset, len(blob), zlib.crc32(blob), len(name)))
+        out.write(name)
+        offset += len(blob)
+    for blob in blobs:
+        out.write(blob)
+    return out.getvalue()
+
+
+# Get the JSON level files in a directory and a fingerprint of their names, sizes and
+# modification times
+def source_fingerprint(level_dir: str) -> Tuple[List[str], int]:
+    files = sorted(f for f in os.listdir(level_dir) if f.endswith('.json'))
+    digest = hashlib.blake2b(digest_size=8)
+    for filename in files:
+        stat = os.stat(os.path.join(level_dir, filename))
+        digest.update(f"{filename}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode("utf-8"))
+    return (files, int.from_bytes(digest.digest(), "little"))
+
+
+# Read JSON level files from a directory. A file the game couldn't load, or one reusing
+# another level's name, is reported and skipped so the rest of the levels still load.
+def _read_specs(level_dir: str, files: List[str]) -> List[dict]:
+    specs = []
+    names = set()
+    for filename in files:
+        try:
+            with open(os.path.join(level_dir, filename)) as f:
+                spec = json.load(f)
+            _check(spec)
+            if spec["name"] in names:
+                raise ValueError(f"Two levels are named {spec['name']!r}")
+        except (OSError, ValueError) as e:
+            print(f"{filename}: skipped, {e}")
+            continue
+        names.add(spec["name"])
+        specs.append(spec)
+    return specs
+
+
+# Open the levels of a directory. A directory of JSON level files is compiled into a
+# cached pack, which is compiled again when the files change; a directory with only a
+# pack in it is opened as it is.
+def open_dir(level_dir: str) -> LevelPack:
+    path = os.path.join(level_dir, PACK_NAME)
+    (files, fingerprint) = source_fingerprint(level_dir)
+    pack: Optional[LevelPack] = None
+    if os.path.exists(path):
+        try:
+            pack = LevelPack.open(path)
+        except ValueError:
+            pack = None
+        if pack and (not files or pack.fingerprint == fingerprint):
+            return pack
+        if pack:
+            pack.close()
+
+    data = compile_pack(_read_specs(level_dir, files), fingerprint)
+
+    # Keep the pack in memory if the directory can't be written to
+    try:
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        return LevelPack(io.BytesIO(data))
+    return LevelPack.open(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile a directory of JSON levels into a level pack, or list a pack.")
+    parser.add_argument("source", help="directory of JSON levels, or a pack with --list")
+    parser.add_argument("output", nargs="?", help=f"pack to write (default: {PACK_NAME} in the source directory)")
+    parser.add_argument("--list", action="store_true", help="list the levels in a pack")
+    args = parser.parse_args()
+
+    if args.list:
+        pack = LevelPack.open(args.source)
+        for entry in pack.entries.values():
+            print(f"{entry.number:6d}  {entry.name}")
+        sys.exit(0)
+
+    # Record the fingerprint, so the game keeps the pack as the source directory's cache
+    # instead of compiling it again
+    (files, fingerprint) = source_fingerprint(args.source)
+    specs = _read_specs(args.source, files)
+    output = args.output or os.path.join(args.source, PACK_NAME)
+    with open(output, "wb") as f:
+        f.write(compile_pack(specs, fingerprint))
+    print(f"Wrote {len(specs)} levels to {output}")
@@ -2,11 +2,15 @@
 import pygame
 import images
 from grid import Grid
+from rules import Level, RULES_VERSION
+from profiler import timed
+from replay import Replay
 
 class LevelUI(object):
     screen: pygame.Surface
     background: pygame.Surface
     grid: Grid
+    level_name: str
 
     def __init__(self, screen: pygame.Surface):
         super(LevelUI, self).__init__()
@@ -15,17 +19,25 @@ class LevelUI(object):
         self.background = None
 
     def load_level_spec(self, level_spec: dict) -> None:
+        if self.grid:
+            self.grid.close()
         level_index = level_spec["level"] - 1
-        self.background = images.LEVEL_BG[level_index]
-        self.grid = Grid(level_spec["dim"][0], level_spec["dim"][1], self.screen, images.LEVEL[level_index])
-        if "objects" in level_spec:
-            self.grid.add_objects(level_spec["objects"])
-        if "weather" in level_spec:
-            self.grid.set_weather(level_spec["weather"])
+        self.level_name = level_spec["name"]
+        (art, self.background) = images.level_art(level_index)
+        self.grid = Grid(Level.from_spec(level_spec), self.screen, art, self.background)
+
+        # The next level is usually the one played next
+        images.preload_level(level_index + 1)
+
+    # Get the inputs made on the level so far as a replay
+    def replay(self) -> Replay:
+        return Replay(self.level_name, RULES_VERSION, list(self.grid.inputs))
 
     def handle_click(self, mouse_pos: tuple[float, float]) -> None:
         self.grid.handle_click(mouse_pos)
 
-    def render_all(self, mouse_pos: tuple[float, float]) -> None:
-        self.screen.blit(self.background, (0,0))
-        self.grid.render_all(mouse_pos)
\ No newline at end of file
+    # Render the level, returning the screen areas that were drawn
+    @timed("level render")
+    def render_all(self, mouse_pos: tuple[float, float], full: bool=False) -> list[pygame.Rect]:
+        # The grid's static layer already holds the background
+        return self.grid.render_all(mouse_pos, full)
\ No newline at end of file
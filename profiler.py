@@ -0,0 +1,181 @@
+import json
+import time
+from collections import deque
+from functools import wraps
+from typing import Deque, Dict, List, Optional, Tuple
+
+import pygame
+
+from styles import BLACK, WHITE
+
+# Built-in frame profiler. Hot paths are wrapped in named timers that cost a single
+# flag check while profiling is off. While it is on, every timer records a span: spans
+# are totalled per frame for the overlay, and the most recent ones can be written out
+# as a Chrome trace (open it in chrome://tracing or Perfetto).
+
+# Phases in the order the overlay lists them. Timers nest: dice are drawn inside
+# triangles, which are drawn inside the grid and level renders. Frames also record a
+# "wait" phase for the time spent asleep, which is left out of the frame time.
+PHASES = ["events", "arrows", "propagation", "win check", "triangles", "dice", "grid render", "level render", "display"]
+
+
+class Span:
+    profiler: "Profiler"
+    name: str
+    start: Optional[float]              # None if profiling was off when the span began
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self) -> None:
+        if self.profiler.enabled:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        if self.start is not None and self.profiler.enabled:
+            self.profiler.record(self.name, self.start, time.perf_counter())
+
+
+class Profiler:
+    HISTORY: int = 300                  # frames kept for the percentiles and the breakdown
+    MAX_SPANS: int = 200000             # spans kept for the trace
+    OVERLAY_SIZE: Tuple[int, int] = (330, 310)
+    FONT_SIZE: int = 16
+
+    enabled: bool
+    frame_times: Deque[float]           # seconds spent on each frame
+    frame_ends: Deque[float]            # when each frame ended, for the frame rate
+    phase_times: Dict[str, Deque[float]]    # seconds spent in each phase per frame
+    spans: Deque[Tuple[str, float, float]]  # (name, start, end) of every timed call
+    origin: float                       # time the trace starts from
+    _frame: Dict[str, float]            # seconds spent in each phase so far this frame
+    _frame_start: Optional[float]
+    _font: Optional[pygame.font.Font]
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self._font = None
+        self.clear()
+
+    # Forget everything recorded so far
+    def clear(self) -> None:
+        self.frame_times = deque(maxlen=self.HISTORY)
+        self.frame_ends = deque(maxlen=self.HISTORY)
+        self.phase_times = {name: deque(maxlen=self.HISTORY) for name in PHASES}
+        self.spans = deque(maxlen=self.MAX_SPANS)
+        self._frame = dict()
+        self._frame_start = None
+
+    # Turn recording on or off
+    def toggle(self) -> None:
+        self.enabled = not self.enabled
+        if self.enabled:
+            self.clear()
+
+    # Time a block: `with PROFILER.phase("events"): ...`
+    def phase(self, name: str) -> Span:
+        return Span(self, name)
+
+    # Decorator timing every call of a function
+    def timed(self, name: str):
+        def wrap(f):
+            @wraps(f)
+            def timed_call(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.record(name, start, time.perf_counter())
+            return timed_call
+        return wrap
+
+    # Add a finished span to the frame and the trace
+    def record(self, name: str, start: float, end: float) -> None:
+        self._frame[name] = self._frame.get(name, 0.0) + (end - start)
+        self.spans.append((name, start, end))
+
+    # Mark the start of a frame
+    def start_frame(self) -> None:
+        if self.enabled:
+            self._frame_start = time.perf_counter()
+            self._frame = dict()
+
+    # Mark the end of a frame. Time spent in the "wait" phase, sleeping until there is
+    # something to do, doesn't count towards the frame time.
+    def end_frame(self) -> None:
+        if not self.enabled or self._frame_start is None:
+            return
+        end = time.perf_counter()
+        self.record("frame", self._frame_start, end)
+        self.frame_times.append(end - self._frame_start - self._frame.get("wait", 0.0))
+        self.frame_ends.append(end)
+        for name in PHASES:
+            self.phase_times[name].append(self._frame.get(name, 0.0))
+        self._frame_start = None
+
+    # Frames drawn over the last second
+    def fps(self) -> int:
+        if not self.frame_ends:
+            return 0
+        now = time.perf_counter()
+        return sum(now - t <= 1.0 for t in self.frame_ends)
+
+    # Frame time in milliseconds at each of the given percentiles
+    def percentiles(self, ps: List[float]) -> List[float]:
+        times = sorted(self.frame_times)
+        if not times:
+            return [0.0 for _ in ps]
+        return [1000*times[min(len(times) - 1, int(p/100*len(times)))] for p in ps]
+
+    # Mean milliseconds per frame spent in a phase
+    def phase_ms(self, name: str) -> float:
+        times = self.phase_times[name]
+        return 1000*sum(times)/len(times) if times else 0.0
+
+    # Lines of text the overlay shows
+    def report(self) -> List[str]:
+        (p50, p95, p99, worst) = self.percentiles([50, 95, 99, 100])
+        lines = [
+            f"FPS {self.fps():4d}   frames {len(self.frame_times)}",
+            f"frame ms p50 {p50:.2f} p95 {p95:.2f}",
+            f"         p99 {p99:.2f} max {worst:.2f}",
+            "phase           ms/frame",
+        ]
+        lines.extend(f"  {name:<14}{self.phase_ms(name):8.3f}" for name in PHASES)
+        return lines
+
+    # Get where the overlay goes: the bottom right corner of the screen
+    def overlay_rect(self, screen: pygame.Surface) -> pygame.Rect:
+        rect = pygame.Rect((0, 0), self.OVERLAY_SIZE)
+        rect.bottomright = screen.get_rect().bottomright
+        return rect
+
+    # Draw the overlay, returning the screen area it covers
+    def render_overlay(self, screen: pygame.Surface) -> pygame.Rect:
+        if self._font is None:
+            pygame.font.init()
+            self._font = pygame.font.SysFont('monospace', self.FONT_SIZE)
+        rect = self.overlay_rect(screen)
+        screen.fill(BLACK, rect)
+        for (i, line) in enumerate(self.report()):
+            screen.blit(self._font.render(line, False, WHITE), (rect.x + 8, rect.y + 8 + (self.FONT_SIZE + 6)*i))
+        return rect
+
+    # Write the recorded spans as a Chrome trace
+    def export(self, path: str) -> None:
+        events = [
+            {"name": name, "cat": "frame" if name == "frame" else "phase", "ph": "X",
+             "ts": (start - self.origin)*1e6, "dur": (end - start)*1e6, "pid": 1, "tid": 1}
+            for (name, start, end) in self.spans
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+PROFILER = Profiler()
+timed = PROFILER.timed
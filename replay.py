@@ -0,0 +1,196 @@
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import level_pack
+from rules import Coord, Level, Move, RULES_VERSION, State
+from solver import level_files
+
+# Recorded play. A replay is the sequence of inputs that changed the puzzle state: the
+# triangles clicked to make moves, undos, redos and restarts. It is tagged with the
+# level's name and the rules version it was played under.
+#
+# Replays can be watched in real time, clicking through the game's own UI, or fast-
+# forwarded headlessly through the rules alone. Either way a replay passes if every
+# input still does something and the level ends up won, so an archive of player
+# solutions doubles as a regression test for rule changes.
+
+UNDO = "undo"
+REDO = "redo"
+RESTART = "restart"
+
+Action = Union[Coord, str]              # clicked triangle, or UNDO, REDO or RESTART
+
+
+class Replay(NamedTuple):
+    level: str                          # name of the level played
+    rules_version: int                  # RULES_VERSION the replay was recorded under
+    actions: List[Action]
+
+    # Get the replay as a JSON object
+    def to_json(self) -> dict:
+        return {
+            "level": self.level,
+            "rules_version": self.rules_version,
+            "actions": [a if isinstance(a, str) else list(a) for a in self.actions],
+        }
+
+    @staticmethod
+    def from_json(data: dict) -> "Replay":
+        actions: List[Action] = []
+        for a in data["actions"]:
+            if a in (UNDO, REDO, RESTART):
+                actions.append(a)
+            elif isinstance(a, list) and len(a) == 3 and all(isinstance(c, int) for c in a):
+                actions.append(tuple(a))
+            else:
+                raise ValueError(f"Unknown replay action {a!r}")
+        return Replay(data["level"], data["rules_version"], actions)
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f)
+
+    @staticmethod
+    def load(path: str) -> "Replay":
+        with open(path) as f:
+            return Replay.from_json(json.load(f))
+
+
+# Play a replay through the rules alone, returning the final state. Raises ValueError
+# at the first input that wouldn't do anything.
+def fast_forward(level: Level, replay: Replay) -> State:
+    state = level.start
+    history: List[Tuple[State, Move]] = []     # state before every move, and the move
+    redo: List[Move] = []
+    for (i, a) in enumerate(replay.actions):
+        if a == RESTART:
+            state = level.start
+            history.clear()
+            redo.clear()
+        elif a == UNDO:
+            if not history:
+                raise ValueError(f"Input {i}: nothing to undo")
+            (state, m) = history.pop()
+            redo.append(m)
+        elif a == REDO:
+            if not redo:
+                raise ValueError(f"Input {i}: nothing to redo")
+            m = redo.pop()
+            history.append((state, m))
+            state = level.step(state, m)
+        else:
+            m = level.move_to(state, a)
+            if m is None:
+                raise ValueError(f"Input {i}: clicking {a} is not a legal move")
+            redo.clear()
+            history.append((state, m))
+            state = level.step(state, m)
+    return state
+
+
+# Fast-forward a replay and check that it wins the level. Returns None if it does, or
+# what went wrong.
+def check(level: Level, replay: Replay) -> Optional[str]:
+    try:
+        state = fast_forward(level, replay)
+    except ValueError as e:
+        return str(e)
+    return None if level.is_won(state) else "level not won at the end"
+
+
+# Play a replay on screen through the game's UI, one input every delay seconds.
+# Returns whether the level was won, or None if the window was closed first.
+def watch(screen, spec: dict, replay: Replay, delay: float=0.3) -> Optional[bool]:
+    import pygame
+    from level_ui import LevelUI
+    level_ui = LevelUI(screen)
+    level_ui.load_level_spec(spec)
+    grid = level_ui.grid
+    pygame.display.set_caption(f"Replay: {replay.level}")
+
+    for a in [None] + replay.actions:
+        if a == RESTART:
+            grid.reset()
+        elif a == UNDO:
+            grid.undo()
+        elif a == REDO:
+            grid.redo()
+        elif a is not None:
+            level_ui.handle_click(grid.triangle_centre(*a))
+        level_ui.render_all(pygame.mouse.get_pos(), True)
+        pygame.display.update()
+
+        deadline = time.perf_counter() + delay
+        while time.perf_counter() < deadline:
+            if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                grid.close()
+                return None
+            time.sleep(0.01)
+
+    grid.close()
+    return grid.won
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that recorded replays still win their levels.")
+    parser.add_argument("paths", nargs="*", default=["replays"], help="replay files or directories (default: replays)")
+    parser.add_argument("--levels", default="levels", help="directory of the levels the replays were played on")
+    parser.add_argument("--watch", action="store_true", help="play each replay in a window instead")
+    parser.add_argument("--delay", type=float, default=0.3, help="seconds between inputs when watching")
+    parser.add_argument("--repeat", type=int, default=1, help="fast-forward every replay this many times, to measure throughput")
+    args = parser.parse_args()
+
+    pack = level_pack.open_dir(args.levels)
+    levels: Dict[str, Level] = dict()
+    replays = []
+    failed = 0
+    for path in level_files(args.paths):
+        try:
+            replay = Replay.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"{path}: can't load: {e}")
+            failed += 1
+            continue
+        if replay.level not in pack.entries:
+            print(f"{path}: no level named {replay.level!r}")
+            failed += 1
+            continue
+        if replay.level not in levels:
+            levels[replay.level] = Level.from_spec(pack.spec(replay.level))
+        replays.append((path, replay))
+
+    if args.watch:
+        import pygame
+        pygame.init()
+        screen = pygame.display.set_mode([1600, 900])
+
+    passed = []
+    for (path, replay) in replays:
+        note = "" if replay.rules_version == RULES_VERSION else f" (recorded under rules version {replay.rules_version})"
+        if args.watch:
+            won = watch(screen, pack.spec(replay.level), replay, args.delay)
+            if won is None:
+                break
+            problem = None if won else "level not won at the end"
+        else:
+            problem = check(levels[replay.level], replay)
+        if problem:
+            failed += 1
+            print(f"{path}: FAILED, {problem}{note}")
+        else:
+            passed.append(replay)
+            print(f"{path}: won {replay.level} in {len(replay.actions)} inputs{note}")
+
+    if args.repeat > 1 and passed:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for replay in passed:
+                fast_forward(levels[replay.level], replay)
+        elapsed = time.perf_counter() - start
+        count = args.repeat*len(passed)
+        inputs = args.repeat*sum(len(replay.actions) for replay in passed)
+        print(f"{count/elapsed:.0f} replays/s, {inputs/elapsed:.0f} inputs/s")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,529 @@
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+# Pure-Python puzzle rules. Nothing in here may import pygame, so levels can be
+# simulated headlessly (batch jobs, solvers, tests on machines without a display).
+
+Coord = Tuple[int, int, int]
+Faces = Tuple[str, str, str, str]       # die faces in the order [T, X, Y, R]
+
+# Bump whenever a rules change can make the same inputs play out differently, so
+# recorded replays say which rules they were played under
+RULES_VERSION = 1
+
+
+class Direction:
+    X = 0
+    Y = 1
+    R = 2
+
+    @staticmethod
+    def left(direction: int) -> int:
+        return (direction + 2) % 3
+
+    @staticmethod
+    def right(direction: int) -> int:
+        return (direction + 1) % 3
+
+DIRECTIONS = [Direction.X, Direction.Y, Direction.R]
+
+
+# Get the coordinates shifted in that direction
+def add_dir(x: int, y: int, r: int, d: int) -> Coord:
+    if d == Direction.R:
+        return (x, y, 1-r)
+
+    pm = 1 if r == 1 else -1
+    if d == Direction.X:
+        return (x+pm, y, 1-r)
+    return (x, y+pm, 1-r)
+
+
+# Reorder a JSON face list into [T, X, Y, R]
+def parse_faces(faces: List[str], r: int) -> Faces:
+    if r == 0:
+        # When faceup, list of faces provided in the order [T, Y, R, X]
+        return (faces[0], faces[3], faces[1], faces[2])
+    # When faceup, list of faces provided in the order [T, X, R, Y]
+    return (faces[0], faces[1], faces[3], faces[2])
+
+
+# Turn a [T, X, Y, R] tuple over in direction d, or slide it if it starts on a front.
+# This is the only statement of the roll and slide rules; the tables below are built from it.
+def _turn(faces: tuple, d: int, front: bool, player_d: Optional[int]=None) -> tuple:
+    (t, x, y, r) = faces
+    if front and player_d is not None:
+        # Slides keep the top face and hinge around the corner furthest from the player
+        if d == Direction.right(player_d):
+            # [T, X, Y, R] -> [T, Y, R, X]
+            return (t, y, r, x)
+        if d == Direction.left(player_d):
+            # [T, X, Y, R] -> [T, R, X, Y]
+            return (t, r, x, y)
+        return faces
+
+    if d == Direction.X:
+        # X comes up: [X, T, R, Y]
+        return (x, t, r, y)
+    if d == Direction.Y:
+        # Y comes up: [Y, R, T, X]
+        return (y, r, t, x)
+    # R comes up: [R, Y, X, T]
+    return (r, y, x, t)
+
+
+# Find every orientation reachable by rolling and sliding from the starting one
+def _all_orientations() -> List[Tuple[int, int, int, int]]:
+    found = [(0, 1, 2, 3)]
+    for o in found:
+        for d in DIRECTIONS:
+            for p in (None, Direction.left(d), Direction.right(d)):
+                turned = _turn(o, d, p is not None, p)
+                if turned not in found:
+                    found.append(turned)
+    return found
+
+# The 12 rotational orientations of a d4, as the index of the starting face now on each
+# of [T, X, Y, R]. Orientation 0 is the starting orientation.
+ORIENTATIONS = _all_orientations()
+_ORIENTATION_IDS = {o: i for (i, o) in enumerate(ORIENTATIONS)}
+
+# TURNS[o][d][p] is the orientation after moving orientation o in direction d, where p is
+# the player's direction for a slide off a front and ROLL for a normal roll
+ROLL = 3
+TURNS: List[List[List[int]]] = [
+    [[_ORIENTATION_IDS[_turn(o, d, p != ROLL, p)] for p in DIRECTIONS + [ROLL]] for d in DIRECTIONS]
+    for o in ORIENTATIONS
+]
+
+
+# Turn a die over in direction d, or slide it if it starts on a front
+def roll(orientation: int, d: int, front: bool, player_d: Optional[int]=None) -> int:
+    return TURNS[orientation][d][player_d if front and player_d is not None else ROLL]
+
+
+# Get a die's faces in the order [T, X, Y, R] for an orientation
+def face_order(faces: Faces, orientation: int) -> Faces:
+    (t, x, y, r) = ORIENTATIONS[orientation]
+    return (faces[t], faces[x], faces[y], faces[r])
+
+
+class Move(NamedTuple):
+    player_end: Coord                   # where the player ends up (the pushed die's start for pushes)
+    player_dir: int                     # direction the player moves in
+    dice_end: Optional[Coord] = None    # where the pushed die ends up
+    dice_dir: Optional[int] = None      # direction the pushed die moves in
+
+    # The triangle that has to be clicked to make this move
+    def target(self) -> Coord:
+        return self.dice_end if self.dice_end is not None else self.player_end
+
+
+class State(NamedTuple):
+    player: Optional[Coord]                     # player location
+    dice: Tuple[Tuple[Coord, int], ...]         # (location, orientation) of every die, in level order
+
+
+class Delta(NamedTuple):
+    move: Move                          # the move that was made
+    player: Optional[Coord]             # player location before the move
+    die: int                            # index of the pushed die, or -1 if nothing was pushed
+    die_before: Optional[Tuple[Coord, int]] = None      # (location, orientation) of the pushed die before the move
+
+
+class Evaluation(NamedTuple):
+    values: Tuple[Optional[int], ...]   # calculated value of every die, in level order
+    valid: Tuple[Optional[bool], ...]   # whether every die is part of a valid equation
+    won: bool
+
+
+# Face operators, compiled once from labels like "3", "=3", "+3", "-3", "x3" and "/3"
+NUM = 0
+EQ = 1
+ADD = 2
+SUB = 3
+MUL = 4
+DIV = 5
+_OPERATORS = {'=': EQ, '+': ADD, '-': SUB, 'x': MUL, '/': DIV}
+
+Op = Tuple[int, int]                    # (opcode, operand)
+
+
+# Compile a face label into an (opcode, operand) pair, rejecting malformed labels
+def compile_face(face: str) -> Op:
+    op = _OPERATORS.get(face[:1], NUM)
+    digits = face[1:] if op != NUM else face
+    # Operands may be negative, as in "=-2"; a leading '-' on its own already means subtract
+    unsigned = digits[1:] if op != NUM and digits.startswith('-') else digits
+    if not (unsigned.isascii() and unsigned.isdigit()):
+        raise ValueError(f"Malformed die face {face!r}")
+    operand = int(digits)
+    if op == DIV and operand == 0:
+        raise ValueError(f"Die face {face!r} divides by zero")
+    return (op, operand)
+
+
+# Apply a compiled face to an incoming value, recording the die's value and validity
+def _calc_value(op: Op, input_num: Optional[int], values: list, valid: list, i: int) -> Optional[int]:
+    def set_value(value: int) -> None:
+        if valid[i] == False:
+            return
+        if values[i] is None:
+            values[i] = value
+            valid[i] = True
+        elif values[i] != value:
+            values[i] = None
+            valid[i] = False
+
+    (opcode, operand) = op
+    if opcode == NUM:
+        set_value(operand)
+    elif opcode == EQ:
+        if input_num == operand:
+            set_value(input_num)
+        elif input_num is not None:
+            valid[i] = False
+    elif opcode == DIV:
+        if input_num:
+            set_value(input_num // operand)
+    elif input_num is not None:
+        if opcode == ADD:
+            set_value(input_num + operand)
+        elif opcode == SUB:
+            set_value(input_num - operand)
+        else:
+            set_value(input_num * operand)
+
+    return values[i]
+
+
+# Zobrist keys come from a fixed 64-bit mix of a feature number (splitmix64), so every
+# run and every process hashes the same state the same way without storing a key per
+# (die, cell, orientation), which would not fit for large generated boards
+_MASK64 = (1 << 64) - 1
+
+def _mix64(x: int) -> int:
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class Level:
+    width: int
+    height: int
+    walls: FrozenSet[Coord]             # triangles that can never be entered
+    fronts: FrozenSet[Coord]            # triangles on which dice slide instead of rolling
+    start: State                        # initial state of the level
+    die_faces: List[Faces]              # faces of every die in its starting orientation
+    cells: List[Coord]                  # coordinates of every flat cell id
+    ids: Dict[Coord, int]               # flat cell id of every coordinate
+    adjacent: List[int]                 # adjacent[3*cell + d] is the cell in direction d, or -1 off the grid
+    _neighbours: Dict[Coord, List[Tuple[int, Coord]]]   # in-bounds (direction, coordinates) around every cell
+    _cell_bits: int                     # bits needed for a cell id in a packed state
+    _player_keys: List[int]             # Zobrist key of the player on every cell
+    _face_orders: List[List[Faces]]     # per die, its faces in every orientation
+    _top_faces: List[List[str]]         # per die, its top face in every orientation
+    _top_ops: List[List[Op]]            # per die, its compiled top face in every orientation
+
+    def __init__(self, width: int, height: int, walls: FrozenSet[Coord], fronts: FrozenSet[Coord], start: State, die_faces: List[Faces]):
+        self.width = width
+        self.height = height
+        self.walls = walls
+        self.fronts = fronts
+        self.start = start
+        self.die_faces = die_faces
+
+        # The topology never changes, so work out every neighbour once
+        n = width*height*2
+        self.cells = [self.cell_coord(c) for c in range(n)]
+        self.ids = {coord: c for (c, coord) in enumerate(self.cells)}
+        self.adjacent = [-1] * (3*n)
+        for (c, coord) in enumerate(self.cells):
+            for d in DIRECTIONS:
+                adj = add_dir(*coord, d)
+                if self.in_bounds(*adj):
+                    self.adjacent[3*c + d] = self.cell_id(*adj)
+        self._neighbours = {
+            coord: [(d, self.cells[self.adjacent[3*c + d]]) for d in DIRECTIONS if self.adjacent[3*c + d] >= 0]
+            for (c, coord) in enumerate(self.cells)
+        }
+        self._cell_bits = n.bit_length()
+        self._player_keys = [_mix64(c) for c in range(n)]
+
+        self._face_orders = [[face_order(faces, o) for o in range(len(ORIENTATIONS))] for faces in die_faces]
+        self._top_faces = [[f[0] for f in orders] for orders in self._face_orders]
+
+        # Compile every face up front so a malformed level fails to load instead of mid-game
+        compiled = [{f: compile_face(f) for f in faces} for faces in die_faces]
+        self._top_ops = [[compiled[i][f] for f in tops] for (i, tops) in enumerate(self._top_faces)]
+
+    # Build a level from level JSON
+    @staticmethod
+    def from_spec(spec: dict) -> "Level":
+        player = None
+        walls = set()
+        dice = []
+        die_faces = []
+        for o in spec.get("objects", []):
+            loc = tuple(o["loc"])
+            if o["type"] == "start":
+                player = loc
+            elif o["type"] == "d4":
+                if len(o["faces"]) != 4:
+                    raise ValueError(f"d4 at {loc} needs 4 faces, got {len(o['faces'])}")
+                dice.append((loc, 0))
+                die_faces.append(parse_faces(o["faces"], loc[2]))
+            elif o["type"] == "wall":
+                walls.add(loc)
+
+        fronts = set()
+        for w in spec.get("weather", []):
+            if w["type"] == "front":
+                fronts.add(tuple(w["loc"]))
+
+        return Level(spec["dim"][0], spec["dim"][1], frozenset(walls), frozenset(fronts), State(player, tuple(dice)), die_faces)
+
+    # Check that the coordinates are in the grid
+    def in_bounds(self, x: int, y: int, r: int) -> bool:
+        return 0 <= x < self.width and 0 <= y < self.height and 0 <= r <= 1
+
+    # Get a flat id for the coordinates
+    def cell_id(self, x: int, y: int, r: int) -> int:
+        return (x*self.height + y)*2 + r
+
+    # Get the coordinates for a flat cell id
+    def cell_coord(self, cell: int) -> Coord:
+        return (cell // 2 // self.height, cell // 2 % self.height, cell % 2)
+
+    # Get the faces of die i in the order [T, X, Y, R] for an orientation
+    def faces(self, i: int, orientation: int) -> Faces:
+        return self._face_orders[i][orientation]
+
+    # Get the top face of die i for an orientation
+    def top_face(self, i: int, orientation: int) -> str:
+        return self._top_faces[i][orientation]
+
+    # Get the compiled top face of die i for an orientation
+    def top_op(self, i: int, orientation: int) -> Op:
+        return self._top_ops[i][orientation]
+
+    # Pack a state into a single int: the player's cell, then the cell and orientation
+    # of every die, each in a fixed-width bit field (a d4 has 12 orientations)
+    def pack(self, state: State) -> int:
+        cell_bits = self._cell_bits
+        key = self.ids[state.player] + 1 if state.player is not None else 0
+        for (loc, o) in state.dice:
+            key = key << (cell_bits + 4) | self.ids[loc] << 4 | o
+        return key
+
+    # Zobrist key of a die on a cell in an orientation
+    def _die_key(self, i: int, loc: Coord, orientation: int) -> int:
+        return _mix64(len(self.cells) + (i*len(self.cells) + self.ids[loc])*len(ORIENTATIONS) + orientation)
+
+    # Get the 64-bit Zobrist hash of a state. Unlike pack it can collide, but it stays
+    # one machine word however many dice there are and rehash updates it in O(1).
+    def zobrist(self, state: State) -> int:
+        key = self._player_keys[self.ids[state.player]] if state.player is not None else 0
+        for (i, (loc, o)) in enumerate(state.dice):
+            key ^= self._die_key(i, loc, o)
+        return key
+
+    # Update a Zobrist hash across a move, given its delta and the state after the move.
+    # XOR undoes itself, so the same call takes the hash back again when reverting.
+    def rehash(self, key: int, delta: Delta, state: State) -> int:
+        if delta.player is not None:
+            key ^= self._player_keys[self.ids[delta.player]]
+        if state.player is not None:
+            key ^= self._player_keys[self.ids[state.player]]
+        if delta.die >= 0:
+            key ^= self._die_key(delta.die, *delta.die_before)
+            key ^= self._die_key(delta.die, *state.dice[delta.die])
+        return key
+
+    # Rebuild a state from its packed key
+    def unpack(self, key: int) -> State:
+        cell_bits = self._cell_bits
+        mask = (1 << (cell_bits + 4)) - 1
+        dice = []
+        for _ in range(len(self.start.dice)):
+            field = key & mask
+            key >>= cell_bits + 4
+            dice.append((self.cells[field >> 4], field & 15))
+        dice.reverse()
+        player = self.cells[key - 1] if key else None
+        return State(player, tuple(dice))
+
+    # Get the in-bounds neighbours of the given coordinates as (direction, coordinates).
+    # The list is shared, so callers must not modify it.
+    def neighbours(self, x: int, y: int, r: int) -> List[Tuple[int, Coord]]:
+        return self._neighbours[(x, y, r)]
+
+    # Get the coordinates in direction d, or None if that is off the grid
+    def neighbour(self, x: int, y: int, r: int, d: int) -> Optional[Coord]:
+        adj = self.adjacent[3*self.ids[(x, y, r)] + d]
+        return self.cells[adj] if adj >= 0 else None
+
+    # Map every occupied location to the index of the die on it (-1 for the player)
+    def occupants(self, state: State) -> Dict[Coord, int]:
+        occupied = {loc: i for (i, (loc, _)) in enumerate(state.dice)}
+        if state.player is not None:
+            occupied[state.player] = -1
+        return occupied
+
+    # List every move the player can make, in the order Grid.handle_click checks them
+    def legal_moves(self, state: State) -> List[Move]:
+        moves: List[Move] = []
+        if state.player is None:
+            return moves
+
+        occupied = self.occupants(state)
+        for (d, adj) in self.neighbours(*state.player):
+            if adj in self.walls:
+                continue
+            if adj not in occupied:
+                moves.append(Move(adj, d))
+            elif occupied[adj] >= 0:
+                for (adj_d, adj_adj) in self.neighbours(*adj):
+                    if adj_adj == state.player or adj_adj in self.walls or adj_adj in occupied:
+                        continue
+                    moves.append(Move(adj, d, adj_adj, adj_d))
+        return moves
+
+    # Find the legal move that ends by clicking the given triangle, if any
+    def move_to(self, state: State, target: Coord) -> Optional[Move]:
+        for m in self.legal_moves(state):
+            if m.target() == target:
+                return m
+        return None
+
+    # Apply a legal move and return the resulting state
+    def step(self, state: State, move: Move) -> State:
+        dice = state.dice
+        if move.dice_end is not None:
+            dice = tuple(
+                (move.dice_end, roll(o, move.dice_dir, loc in self.fronts, move.player_dir))
+                if loc == move.player_end else (loc, o)
+                for (loc, o) in dice
+            )
+        return State(move.player_end, dice)
+
+    # Record what a move is about to change in a state, so revert can put it back
+    def delta(self, state: State, move: Move) -> Delta:
+        if move.dice_end is not None:
+            for (i, (loc, o)) in enumerate(state.dice):
+                if loc == move.player_end:
+                    return Delta(move, state.player, i, (loc, o))
+        return Delta(move, state.player, -1)
+
+    # Put back what a move changed, without working the roll out backwards
+    def revert(self, state: State, delta: Delta) -> State:
+        dice = state.dice
+        if delta.die >= 0:
+            dice = dice[:delta.die] + (delta.die_before,) + dice[delta.die + 1:]
+        return State(delta.player, dice)
+
+    # Evaluate the equations formed by the dice
+    def evaluate(self, state: State) -> Evaluation:
+        return self._evaluate_all(state, {loc: i for (i, (loc, _)) in enumerate(state.dice)})
+
+    # Evaluate every die, given the index of the die at every occupied location
+    def _evaluate_all(self, state: State, dice_at: Dict[Coord, int]) -> Evaluation:
+        n = len(state.dice)
+        values: List[Optional[int]] = [None] * n
+        valid: List[Optional[bool]] = [None] * n
+        self._evaluate_cells(state, dice_at, dice_at, values, valid)
+        won = all(v == True for v in valid)
+        return Evaluation(tuple(values), tuple(valid), won)
+
+    # Re-evaluate after a move, undo or restart, given the evaluation of the previous state.
+    # Values only flow along chains of adjacent dice, so only the chains that a changed
+    # die left or joined are recalculated; every other die keeps its cached result.
+    def reevaluate(self, state: State, previous: State, evaluation: Evaluation) -> Evaluation:
+        return self.reevaluate_dice(state, previous, evaluation)[0]
+
+    # Re-evaluate like reevaluate, and also list the dice that were recalculated. No other
+    # die's value or validity can have changed.
+    def reevaluate_dice(self, state: State, previous: State, evaluation: Evaluation) -> Tuple[Evaluation, List[int]]:
+        if len(previous.dice) != len(state.dice):
+            return (self.evaluate(state), list(range(len(state.dice))))
+
+        dice_at = {loc: i for (i, (loc, _)) in enumerate(state.dice)}
+        seeds = []
+        for (now, before) in zip(state.dice, previous.dice):
+            if now == before:
+                continue
+            seeds.append(now[0])
+            seeds.extend(adj for (_, adj) in self.neighbours(*before[0]) if adj in dice_at)
+        if not seeds:
+            return (evaluation, [])
+
+        # Collecting the changed chains costs about as much per die as evaluating it, so once
+        # they take in more than an eighth of a large board, evaluating everything is cheaper
+        chains = self._chains(dice_at, seeds, max(len(dice_at) // 8, 32))
+        if chains is None:
+            return (self._evaluate_all(state, dice_at), list(range(len(state.dice))))
+        values = list(evaluation.values)
+        valid = list(evaluation.valid)
+        for loc in chains:
+            values[dice_at[loc]] = None
+            valid[dice_at[loc]] = None
+
+        self._evaluate_cells(state, dice_at, chains, values, valid)
+        won = all(v == True for v in valid)
+        return (Evaluation(tuple(values), tuple(valid), won), [dice_at[loc] for loc in chains])
+
+    # Get every die connected to the seed locations through adjacent dice, or None as soon
+    # as there are more than limit of them
+    def _chains(self, dice_at: Dict[Coord, int], seeds: List[Coord], limit: int) -> Optional[Set[Coord]]:
+        neighbours = self._neighbours
+        chains = {loc for loc in seeds if loc in dice_at}
+        stack = list(chains)
+        while stack:
+            for (_, adj) in neighbours[stack.pop()]:
+                if adj in dice_at and adj not in chains:
+                    chains.add(adj)
+                    stack.append(adj)
+            if len(chains) > limit:
+                return None
+        return chains
+
+    # Propagate values outwards from the given dice, visiting triangles in grid order
+    def _evaluate_cells(self, state: State, dice_at: Dict[Coord, int], cells: Iterable[Coord], values: list, valid: list) -> None:
+        used = set()
+        for loc in sorted(cells):
+            if loc in used:
+                continue
+            i = dice_at[loc]
+            v = _calc_value(self._top_ops[i][state.dice[i][1]], None, values, valid, i)
+            if v is not None:
+                self._propagate(state, dice_at, loc, v, used, values, valid)
+
+    # Depth-first from loc, like a recursive walk but with an explicit stack so long chains
+    # of dice can't hit the recursion limit. Each frame holds a die, the value it passes on
+    # and an iterator over the neighbours it still has to visit.
+    def _propagate(self, state: State, dice_at: Dict[Coord, int], loc: Coord, value: int, used: set, values: list, valid: list) -> None:
+        used.add(loc)
+        stack = [(value, iter(self.neighbours(*loc)))]
+        while stack:
+            (value, todo) = stack[-1]
+            for (_, adj) in todo:
+                if adj in used or adj not in dice_at:
+                    continue
+
+                i = dice_at[adj]
+                v = _calc_value(self._top_ops[i][state.dice[i][1]], value, values, valid, i)
+                if v is not None:
+                    used.add(adj)
+                    stack.append((v, iter(self.neighbours(*adj))))
+                    break
+            else:
+                stack.pop()
+
+    # Check whether the state solves the level
+    def is_won(self, state: State) -> bool:
+        # Cheap necessary condition first: every operator die needs a die next to it to get a value
+        dice_at = {loc for (loc, _) in state.dice}
+        for (i, (loc, o)) in enumerate(state.dice):
+            if self._top_ops[i][o][0] != NUM and not any(adj in dice_at for (_, adj) in self.neighbours(*loc)):
+                return False
+        return self.evaluate(state).won
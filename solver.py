@@ -0,0 +1,217 @@
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from rules import Level, Move, State
+
+# Shortest-solution search over rules.Level. Every move costs one, so a plain
+# breadth-first search already returns an optimal move sequence.
+
+class SearchResult(NamedTuple):
+    moves: Optional[List[Move]]         # shortest winning move sequence, or None if unsolvable
+    explored: int                       # number of states expanded
+    generated: int                      # number of successor states generated
+    complete: bool = True               # False if max_states ran out before the search finished
+
+
+# Breadth-first search for the shortest winning move sequence, from the level's start
+# or from another state
+def search(level: Level, max_states: Optional[int]=None, start: Optional[State]=None) -> SearchResult:
+    if start is None:
+        start = level.start
+    if level.is_won(start):
+        return SearchResult([], 0, 0)
+
+    # States are only kept as packed ints: the visited set doubles as the parent table
+    start_key = level.pack(start)
+    parents: Dict[int, int] = {start_key: -1}
+    frontier = deque([start_key])
+    explored = 0
+    generated = 0
+
+    while frontier:
+        key = frontier.popleft()
+        state = level.unpack(key)
+        explored += 1
+        for m in level.legal_moves(state):
+            nxt = level.step(state, m)
+            nxt_key = level.pack(nxt)
+            generated += 1
+            if nxt_key in parents:
+                continue
+            parents[nxt_key] = key
+
+            if level.is_won(nxt):
+                return SearchResult(_path(level, parents, nxt_key), explored, generated)
+
+            if max_states is not None and len(parents) >= max_states:
+                return SearchResult(None, explored, generated, False)
+            frontier.append(nxt_key)
+
+    return SearchResult(None, explored, generated)
+
+
+# Count the shortest winning move sequences, searching breadth-first one layer at a
+# time. Returns (optimal length, number of optimal sequences), or (None, 0) if there is
+# no solution, or none was found before max_states states were seen.
+def count_solutions(level: Level, max_states: Optional[int]=None) -> Tuple[Optional[int], int]:
+    start = level.pack(level.start)
+    if level.is_won(level.start):
+        return (0, 1)
+
+    seen = {start}
+    layer: Dict[int, int] = {start: 1}   # state -> number of shortest paths reaching it
+    depth = 0
+    while layer:
+        depth += 1
+        nxt: Dict[int, int] = dict()
+        for (key, paths) in layer.items():
+            state = level.unpack(key)
+            for m in level.legal_moves(state):
+                nxt_key = level.pack(level.step(state, m))
+                if nxt_key in seen and nxt_key not in nxt:
+                    continue
+                nxt[nxt_key] = nxt.get(nxt_key, 0) + paths
+        seen.update(nxt)
+
+        solutions = sum(paths for (key, paths) in nxt.items() if level.is_won(level.unpack(key)))
+        if solutions:
+            return (depth, solutions)
+        if max_states is not None and len(seen) >= max_states:
+            break
+        layer = nxt
+    return (None, 0)
+
+
+# Walk the parent table back from a state to the start and recover the moves between
+def _path(level: Level, parents: Dict[int, int], key: int) -> List[Move]:
+    keys = [key]
+    while parents[keys[-1]] != -1:
+        keys.append(parents[keys[-1]])
+    keys.reverse()
+
+    moves: List[Move] = []
+    for (a, b) in zip(keys, keys[1:]):
+        state = level.unpack(a)
+        for m in level.legal_moves(state):
+            if level.pack(level.step(state, m)) == b:
+                moves.append(m)
+                break
+    return moves
+
+
+# Get the shortest winning move sequence for a level, or None if there is none
+def solve(level: Level) -> Optional[List[Move]]:
+    return search(level).moves
+
+
+# Fields of every analyse_file report, in CSV column order
+REPORT_FIELDS = ["file", "name", "solvable", "optimal_moves", "recorded_moves", "explored", "generated", "branching", "seconds", "error"]
+
+
+# Solve one level file and report on the search. solvable is None if max_states ran
+# out first, and error is set instead if the level could not be loaded.
+def analyse_file(path: str, max_states: Optional[int]=None) -> dict:
+    report = dict.fromkeys(REPORT_FIELDS)
+    report["file"] = path
+    start = time.perf_counter()
+    try:
+        with open(path) as f:
+            spec = json.load(f)
+        report["name"] = spec.get("name")
+        report["recorded_moves"] = spec.get("optimal_moves")
+        result = search(Level.from_spec(spec), max_states)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        report["error"] = f"{type(e).__name__}: {e}"
+        report["seconds"] = time.perf_counter() - start
+        return report
+
+    report["seconds"] = time.perf_counter() - start
+    report["solvable"] = result.moves is not None if result.complete else None
+    report["optimal_moves"] = len(result.moves) if result.moves is not None else None
+    report["explored"] = result.explored
+    report["generated"] = result.generated
+    report["branching"] = result.generated / result.explored if result.explored else 0.0
+    return report
+
+
+# Every level file in the given files and directories, in name order per directory
+def level_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.json'))
+        else:
+            files.append(path)
+    return files
+
+
+# Solve level files across worker processes, yielding each report as soon as it is done
+def analyse_levels(files: List[str], jobs: Optional[int]=None, max_states: Optional[int]=None) -> Iterator[dict]:
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(analyse_file, f, max_states) for f in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+# Solve every level in a directory and check the recorded optimal move counts. A level
+# that runs out of max_states before it is solved fails the check.
+def check_levels(level_dir: str, jobs: Optional[int]=None, max_states: Optional[int]=None) -> bool:
+    ok = True
+    for report in analyse_levels(level_files([level_dir]), jobs, max_states):
+        filename = os.path.basename(report["file"])
+        if report["error"] or not report["solvable"]:
+            reason = report["error"] or ("gave up" if report["solvable"] is None else "unsolvable")
+            print(f"{filename}: {reason}")
+            ok = False
+            continue
+
+        recorded = report["recorded_moves"]
+        moves = report["optimal_moves"]
+        status = "ok" if recorded == moves else f"recorded {recorded}"
+        if recorded != moves:
+            ok = False
+        print(f"{filename}: {moves} moves ({status})")
+    return ok
+
+
+# Stream reports to a file as JSON lines or CSV rows as they come in
+def write_reports(reports: Iterator[dict], out, fmt: str) -> None:
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+    for report in reports:
+        if fmt == "csv":
+            writer.writerow(report)
+        else:
+            out.write(json.dumps(report) + "\n")
+        out.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Solve levels in parallel. By default checks the recorded optimal move counts.")
+    parser.add_argument("paths", nargs="*", help="level files or directories (default: levels)")
+    parser.add_argument("--format", choices=["json", "csv"], help="report on every level as JSON lines or CSV instead of checking")
+    parser.add_argument("--jobs", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--max-states", type=int, help="give up on a level after this many states")
+    parser.add_argument("--output", help="file to write the report to (default: stdout)")
+    args = parser.parse_args()
+
+    paths = args.paths or [os.path.join(os.getcwd(), 'levels')]
+    if args.format is None:
+        # Check every path before deciding, so a failure doesn't hide the later ones
+        results = [check_levels(p, args.jobs, args.max_states) for p in paths]
+        sys.exit(0 if all(results) else 1)
+
+    reports = analyse_levels(level_files(paths), args.jobs, args.max_states)
+    if args.output:
+        with open(args.output, "w", newline="") as out:
+            write_reports(reports, out, args.format)
+    else:
+        write_reports(reports, sys.stdout, args.format)
@@ -0,0 +1,114 @@
+import math
+import pygame
+from typing import Dict, Optional, Tuple
+
+import images
+from rules import Direction, DIRECTIONS
+
+# Arrow types drawn by Triangle.render
+MOVE = 0                                # plain move
+PUSH_BOTH = 1                           # push that can go either way around the die
+PUSH_LEFT = 2                           # push that can only go left around the die
+PUSH_RIGHT = 3                          # push that can only go right around the die
+ARROW_TYPES = [MOVE, PUSH_BOTH, PUSH_LEFT, PUSH_RIGHT]
+
+
+# Scale an image to fill a triangle, flipping it if r=1
+def transform_static_image(image: pygame.Surface, unit: float, r: int) -> pygame.Surface:
+    scaled_img = pygame.transform.scale(image, (2*unit, math.sqrt(3)*unit))
+    if r == 1:
+        return pygame.transform.rotate(scaled_img, 180)
+    return scaled_img
+
+
+# Scale, rotate and place an arrow image pointing into a triangle
+def transform_arrow(image: pygame.Surface, unit: float, arrow_direction: int, r: int) -> Tuple[pygame.Surface, Tuple[float, float]]:
+    img = pygame.transform.scale(image, (unit, unit/2))
+    rotation = 0
+    if arrow_direction == Direction.Y:
+        if r == 0:
+            rotation = 180
+    elif arrow_direction == Direction.X:
+        if r == 0:
+            rotation = 60
+        else:
+            rotation = 240
+    elif arrow_direction == Direction.R:
+        if r == 0:
+            rotation = 300
+        else:
+            rotation = 120
+
+    if rotation > 0:
+        img = pygame.transform.rotate(img, rotation)
+
+    # Move the arrow to the right position
+    x_offset = 0
+    y_offset = 0
+
+    # Don't question the math here it's hell
+    if arrow_direction == Direction.Y:
+        if r == 0:
+            x_offset = unit / 2
+            y_offset = -unit / 2
+        else:
+            x_offset = unit / 2
+    elif arrow_direction == Direction.X:
+        if r == 0:
+            x_offset = unit / 4
+            y_offset = -unit * 3 * math.sqrt(3) / 4
+        else:
+            x_offset = unit * (5 - math.sqrt(3)) / 4
+            y_offset = unit * (math.sqrt(3) - 1) / 4
+    elif arrow_direction == Direction.R:
+        if r == 0:
+            x_offset = unit * (5 - math.sqrt(3)) / 4
+            y_offset = -unit * 3 * math.sqrt(3) / 4
+        else:
+            x_offset = unit / 4
+            y_offset = unit * (math.sqrt(3) - 1) / 4
+
+    return (img, (x_offset, y_offset))
+
+
+class SpriteAtlas:
+    unit: float                         # unit length the sprites are scaled for
+    front: pygame.Surface               # front marker
+    arrows: Dict[Tuple[int, bool, int, int], Tuple[pygame.Surface, Tuple[float, float]]]     # (type, mouseover, direction, r) -> (image, offset)
+    statics: Dict[Tuple[int, int], pygame.Surface]      # (id of source image, r) -> image filling the triangle
+
+    # Scale and rotate every sprite once for the given unit length
+    def __init__(self, unit: float):
+        self.unit = unit
+        self.front = pygame.transform.scale(images.FRONT, (unit, unit/2))
+
+        arrow_images = {
+            (MOVE, False): images.MOVE_ARROW,
+            (MOVE, True): images.MOVE_ARROW_HOVER,
+            (PUSH_BOTH, False): images.PUSH_ARROW_BOTH,
+            (PUSH_LEFT, False): pygame.transform.flip(images.PUSH_ARROW_RIGHT, True, False),
+            (PUSH_RIGHT, False): images.PUSH_ARROW_RIGHT,
+        }
+        self.arrows = dict()
+        for ((arrow_type, mouseover), image) in arrow_images.items():
+            for d in DIRECTIONS:
+                for r in range(2):
+                    self.arrows[(arrow_type, mouseover, d, r)] = transform_arrow(image, unit, d, r)
+
+        self.statics = dict()
+        for image in (images.PLAYER_IMG_0, images.PLAYER_IMG_1, images.D4_RED_IMG, images.D4_BLUE_IMG, images.D4_GREEN_IMG, images.D4_YELLOW_IMG):
+            for r in range(2):
+                self.statics[(id(image), r)] = transform_static_image(image, unit, r)
+
+    # Get an image scaled and flipped to fill a triangle
+    def static_image(self, image: pygame.Surface, r: int) -> pygame.Surface:
+        key = (id(image), r)
+        if key not in self.statics:
+            self.statics[key] = transform_static_image(image, self.unit, r)
+        return self.statics[key]
+
+    # Get the arrow image and its offset from the triangle's left corner, if there is an arrow
+    def arrow(self, arrow_direction: int, arrow_type: int, mouseover: bool, r: int) -> Optional[Tuple[pygame.Surface, Tuple[float, float]]]:
+        if arrow_type not in ARROW_TYPES:
+            return None
+        return self.arrows[(arrow_type, mouseover and arrow_type == MOVE, arrow_direction, r)]